@@ -0,0 +1,67 @@
+"""make_ret 微基准：对比旧版逐条 strptime 扫描与预解析的 CodeIndex
+
+用法（需在已安装 AstrBot 的环境中运行）:
+    python bench/bench_make_ret.py [兑换码数量 ...]
+"""
+import datetime
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import CODE_TIME_FORMAT, CodeIndex  # noqa: E402
+
+
+def legacy_make_ret(json_data):
+    """v1.0.13 的 make_ret：每次查询都对每条记录调用 strptime"""
+    if isinstance(json_data, str):
+        return json_data
+
+    valid_keys = []
+    current_time = datetime.datetime.now()
+    for code_item in json_data:
+        if 'code' in code_item and 'end' in code_item:
+            try:
+                end_time = datetime.datetime.strptime(code_item['end'], CODE_TIME_FORMAT)
+                if current_time < end_time:
+                    valid_keys.append(code_item['code'])
+            except Exception:
+                continue
+    return valid_keys
+
+
+def make_codes(count, valid_ratio=0.1):
+    """生成测试数据：大部分已过期，少量仍然有效"""
+    now = datetime.datetime.now()
+    codes = []
+    for i in range(count):
+        if random.random() < valid_ratio:
+            end = now + datetime.timedelta(days=random.randint(1, 30))
+        else:
+            end = now - datetime.timedelta(days=random.randint(1, 365))
+        codes.append({"code": f"CODE{i:06d}", "end": end.strftime(CODE_TIME_FORMAT), "reward": "钻石x100"})
+    random.shuffle(codes)
+    return codes
+
+
+def bench(count, queries=200):
+    codes = make_codes(count)
+    index = CodeIndex(codes)
+    assert sorted(index.valid_codes()) == sorted(legacy_make_ret(codes))
+
+    legacy = min(timeit.repeat(lambda: legacy_make_ret(codes), number=queries, repeat=3)) / queries
+    build = min(timeit.repeat(lambda: CodeIndex(codes), number=5, repeat=3)) / 5
+    query = min(timeit.repeat(index.valid_codes, number=queries, repeat=3)) / queries
+
+    print(f"{count:>8} 条 | 旧版每次查询 {legacy * 1e3:9.3f} ms | "
+          f"CodeIndex 构建 {build * 1e3:9.3f} ms，每次查询 {query * 1e6:9.2f} us | "
+          f"查询加速 {legacy / query:8.0f}x")
+
+
+if __name__ == "__main__":
+    random.seed(5)
+    sizes = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000, 100000]
+    for size in sizes:
+        bench(size)
@@ -0,0 +1,452 @@
+"""离线基准与压测工具：在本地替身服务上运行 MyPlugin，不依赖真实后端和聊天平台
+
+替身包括：
+- 发送 new_code 推送的 Socket.IO 服务，可以随时断开/恢复
+- 提供 /api/codes/{game} 的 HTTP 接口（支持 since 增量参数）
+- 带可配置延迟和失败率的 Context.send_message
+
+报告广播吞吐量、10/1k/10k 订阅者下的 p50/p99 送达延迟、/兑换码 并发查询吞吐量和断线恢复时间。
+
+用法（需在已安装 AstrBot 的环境中运行）:
+    python bench/harness.py
+    python bench/harness.py --subscribers 10,1000 --send-latency 0.05 --failure-rate 0.01
+    python bench/harness.py --skip query,reconnect --output bench_output.txt
+"""
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+
+import socketio
+from aiohttp import web
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class StandInBackend:
+    """本地替身后端：Socket.IO 推送 + 兑换码接口，可以停止后在同一端口重新启动"""
+
+    def __init__(self, port, conditional=True):
+        self.port = port
+        self.conditional = conditional  # 是否支持条件请求（ETag / 304）
+        self.url = f"http://127.0.0.1:{port}"
+        self.codes = {game_type: [] for game_type in main.GAME_TYPES.values()}
+        self.connected_at = []
+        self.fetches = 0
+        self.block_push = False        # 模拟推送通道不可用：拒绝 Socket.IO 连接，兑换码接口照常
+        self.not_modified = 0
+        self.sio = None
+        self.runner = None
+
+    def add_code(self, game_type, key, valid_days=7):
+        end = datetime.datetime.now() + datetime.timedelta(days=valid_days)
+        item = {"code": key, "end": end.strftime(main.CODE_TIME_FORMAT), "reward": "钻石x100",
+                "url": "http://example.invalid/", "created_at": int(time.time() * 1000)}
+        self.codes[game_type].append(item)
+        return item
+
+    async def _get_codes(self, request):
+        self.fetches += 1
+        items = self.codes.get(request.match_info["game"], [])
+        since = request.query.get("since")
+        if since:
+            items = [item for item in items if item["created_at"] >= int(since)]
+        body = json.dumps(items)
+        if not self.conditional:
+            return web.Response(text=body, content_type="application/json")
+        etag = '"%s"' % hashlib.sha1(body.encode()).hexdigest()
+        if request.headers.get("If-None-Match") == etag:
+            self.not_modified += 1
+            return web.Response(status=304, headers={"ETag": etag})
+        return web.Response(text=body, content_type="application/json", headers={"ETag": etag})
+
+    async def drop_push(self):
+        """断开所有 Socket.IO 连接并拒绝重连"""
+        self.block_push = True
+        for sid in list(self.sio.manager.get_participants("/", None)):
+            await self.sio.disconnect(sid[0])
+
+    async def start(self):
+        app = web.Application()
+        self.sio = socketio.AsyncServer(async_mode="aiohttp")
+        self.sio.attach(app)
+
+        @self.sio.event
+        async def connect(sid, environ, auth=None):
+            if self.block_push:
+                return False
+            self.connected_at.append(time.monotonic())
+
+        @self.sio.on(main.HEARTBEAT_EVENT)
+        async def heartbeat(sid, *args):
+            return True
+
+        app.router.add_get("/api/codes/{game}", self._get_codes)
+        # 停止时不等待连接优雅关闭，模拟后端突然掉线
+        self.runner = web.AppRunner(app, shutdown_timeout=0.1, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+
+    async def stop(self):
+        """关闭服务，所有连接都会断开"""
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def emit_code(self, game_type, key):
+        """发布一个新兑换码并推送 new_code，返回推送时间"""
+        item = self.add_code(game_type, key)
+        emitted_at = time.monotonic()
+        await self.sio.emit("new_code", {"game_name": game_type, "key": key, "reward": item["reward"],
+                                         "time": item["end"], "url": item["url"]})
+        return emitted_at
+
+
+class StallingProxy:
+    """转发到替身后端的 TCP 代理，可以让已建立的 Socket.IO 连接停止传输但不关闭，模拟半开连接
+
+    只停掉心跳确认时服务端仍会完成关闭握手，客户端能正常断开；这里连关闭握手也送不到对端。
+    """
+
+    def __init__(self, port, upstream_port):
+        self.port = port
+        self.upstream_port = upstream_port
+        self.url = f"http://127.0.0.1:{port}"
+        self.links = []
+        self.server = None
+
+    async def _pipe(self, reader, writer, link, inspect=False):
+        try:
+            while data := await reader.read(65536):
+                if inspect and b"/socket.io/" in data:
+                    link["socketio"] = True
+                await link["flowing"].wait()
+                writer.write(data)
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def _handle(self, client_reader, client_writer):
+        upstream_reader, upstream_writer = await asyncio.open_connection("127.0.0.1", self.upstream_port)
+        link = {"socketio": False, "flowing": asyncio.Event(), "task": asyncio.current_task(),
+                "writers": (client_writer, upstream_writer)}
+        link["flowing"].set()
+        self.links.append(link)
+        try:
+            await asyncio.gather(self._pipe(client_reader, upstream_writer, link, inspect=True),
+                                 self._pipe(upstream_reader, client_writer, link), return_exceptions=True)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.links.remove(link)
+
+    def stall(self):
+        """已建立的 Socket.IO 连接不再转发任何数据，之后的新连接照常转发"""
+        for link in self.links:
+            if link["socketio"]:
+                link["flowing"].clear()
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._handle, "127.0.0.1", self.port)
+
+    async def stop(self):
+        self.server.close()
+        for link in list(self.links):
+            for writer in link["writers"]:
+                writer.close()
+            link["task"].cancel()
+        await self.server.wait_closed()
+
+
+class FakeContext:
+    """替身 Context：send_message 带可配置的延迟和失败率"""
+
+    def __init__(self, latency, failure_rate):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.sent = {}  # 订阅者 -> 每条消息的送达时间
+        self.messages = 0
+        self.failures = 0
+
+    async def send_message(self, target, message_chain):
+        if self.latency:
+            await asyncio.sleep(random.expovariate(1 / self.latency))
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            raise RuntimeError("模拟发送失败")
+        self.sent.setdefault(target, []).append(time.monotonic())
+        self.messages += 1
+
+
+class FakeEvent:
+    """替身消息事件，只实现 /兑换码 用到的接口"""
+
+    def __init__(self, umo):
+        self.unified_msg_origin = umo
+
+    def plain_result(self, text):
+        return text
+
+
+async def wait_for(condition, timeout, interval=0.01):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("等待超时")
+        await asyncio.sleep(interval)
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.backend = StandInBackend(free_port(), conditional=not args.no_conditional)
+        self.lines = []
+
+    def report(self, line):
+        print(line, flush=True)
+        self.lines.append(line)
+
+    def _configure_paths(self, backend_url=None):
+        """每个场景使用独立的临时数据目录"""
+        data_dir = tempfile.mkdtemp(prefix="nikki5_bench_")
+        main.BACKEND_URL = backend_url or self.backend.url
+        main.SUBSCRIBERS_FILE_PATH = os.path.join(data_dir, "subscribers.json")
+        main.SUBSCRIBERS_JOURNAL_PATH = os.path.join(data_dir, "subscribers.journal")
+        main.PLUGIN_DB_PATH = os.path.join(data_dir, "nikki5_code_tracker.db")
+        main.METRICS_FILE_PATH = os.path.join(data_dir, "nikki5_code_tracker.prom")
+        # 场景之间不做重载交接，每个场景都从头建立连接
+        main.HANDOVER_GRACE = 0
+        main.HEARTBEAT_INTERVAL = self.args.heartbeat_interval
+        main.HEARTBEAT_TIMEOUT = self.args.heartbeat_interval
+        main.LIVENESS_DEADLINE = self.args.liveness_deadline
+        main.RECONNECT_BASE_DELAY = self.args.reconnect_base_delay
+        main.POLL_MIN_INTERVAL = self.args.poll_min_interval
+        main.POLL_MAX_INTERVAL = self.args.poll_max_interval
+        return data_dir
+
+    def _subscribers(self, count):
+        platforms = self.args.platforms
+        return [f"bench{i % platforms}:GroupMessage:{i}" for i in range(count)]
+
+    async def start_plugin(self, subscribers, backend_url=None):
+        """在新的数据目录中启动插件，等待连接和首次同步完成"""
+        self._configure_paths(backend_url)
+        with open(main.SUBSCRIBERS_FILE_PATH, "w", encoding="utf-8") as f:
+            json.dump(subscribers, f)
+
+        args = self.args
+        context = FakeContext(args.send_latency, args.failure_rate)
+        connections = len(self.backend.connected_at)
+        plugin = main.MyPlugin(context)
+        plugin.broadcaster = main.BroadcastScheduler(
+            context.send_message, concurrency=args.concurrency,
+            platform_rate=args.platform_rate, platform_burst=args.platform_rate,
+            target_rate=args.target_rate, target_burst=1)
+        plugin.coalescer.window = args.coalesce_window
+
+        await wait_for(lambda: len(self.backend.connected_at) > connections, timeout=30)
+        # 等首次补偿同步把现有兑换码记入账本
+        await asyncio.sleep(0.2)
+        await plugin.sync_lock.acquire()
+        plugin.sync_lock.release()
+        return plugin, context
+
+    async def stop_plugin(self, plugin):
+        """终止插件并等待连接真正释放"""
+        await plugin.terminate()
+        await wait_for(lambda: plugin.instance_id not in main._plugin_instances, timeout=30)
+
+    async def bench_broadcast(self, count):
+        plugin, context = await self.start_plugin(self._subscribers(count))
+        try:
+            emitted_at = await self.backend.emit_code("infinity", f"BENCH{count}")
+            metrics = plugin.metrics
+            await wait_for(lambda: metrics.deliveries.value + metrics.send_failures.value >= count,
+                           timeout=self.args.timeout)
+            done = [times[-1] - emitted_at for times in context.sent.values()
+                    if len(times) >= 2]
+            elapsed = max(done) if done else float("nan")
+            self.report(f"广播 {count:>6} 订阅者 | 送达 {metrics.deliveries.value:>6}，失败 {metrics.send_failures.value:>5} | "
+                        f"吞吐 {context.messages / elapsed:8.1f} 条消息/秒 | "
+                        f"p50 {percentile(done, 0.5):7.3f}s p99 {percentile(done, 0.99):7.3f}s | "
+                        f"最后送达 {elapsed:7.3f}s")
+        finally:
+            await self.stop_plugin(plugin)
+
+    async def bench_query(self):
+        for i in range(self.args.query_codes):
+            self.backend.add_code("infinity", f"QUERY{i}")
+        plugin, _ = await self.start_plugin([])
+        try:
+            fetches = self.backend.fetches
+            latencies = []
+            stop_at = time.monotonic() + self.args.query_duration
+
+            async def worker(n):
+                event = FakeEvent(f"bench:FriendMessage:{n}")
+                while time.monotonic() < stop_at:
+                    started = time.monotonic()
+                    async for _ in plugin.code(event, "暖5"):
+                        pass
+                    latencies.append(time.monotonic() - started)
+
+            started = time.monotonic()
+            await asyncio.gather(*(worker(n) for n in range(self.args.query_concurrency)))
+            elapsed = time.monotonic() - started
+            self.report(f"查询 并发 {self.args.query_concurrency:>4} | {len(latencies) / elapsed:8.1f} 次/秒 | "
+                        f"p50 {percentile(latencies, 0.5):7.3f}s p99 {percentile(latencies, 0.99):7.3f}s | "
+                        f"后端请求 {self.backend.fetches - fetches} 次")
+        finally:
+            await self.stop_plugin(plugin)
+
+    async def bench_reconnect(self):
+        subscribers = self._subscribers(10)
+        plugin, context = await self.start_plugin(subscribers)
+        try:
+            connections = len(self.backend.connected_at)
+            await self.backend.stop()
+            dropped_at = time.monotonic()
+            # 断线期间发布的兑换码只能通过补偿同步补上
+            self.backend.add_code("infinity", "MISSED")
+            await asyncio.sleep(self.args.outage)
+            restarted_at = time.monotonic()
+            await self.backend.start()
+
+            await wait_for(lambda: len(self.backend.connected_at) > connections, timeout=self.args.timeout)
+            reconnected_at = self.backend.connected_at[-1]
+            await wait_for(lambda: context.messages >= 2 * len(subscribers), timeout=self.args.timeout)
+            caught_up_at = max(times[-1] for times in context.sent.values())
+            self.report(f"断线恢复 停机 {self.args.outage:.1f}s | 恢复后重连 {reconnected_at - restarted_at:7.3f}s | "
+                        f"断线到重连 {reconnected_at - dropped_at:7.3f}s | "
+                        f"补齐断线期间兑换码 {caught_up_at - restarted_at:7.3f}s")
+        finally:
+            await self.stop_plugin(plugin)
+
+    async def bench_halfopen(self):
+        proxy = StallingProxy(free_port(), self.backend.port)
+        await proxy.start()
+        plugin, _ = await self.start_plugin([], backend_url=proxy.url)
+        try:
+            # 等第一次心跳确认后再卡住传输层，之后连接上没有任何存活迹象，关闭握手也完不成
+            await wait_for(lambda: plugin.supervisor.heartbeat_acked, timeout=self.args.timeout)
+            connections = len(self.backend.connected_at)
+            proxy.stall()
+            stalled_at = time.monotonic()
+            await wait_for(lambda: len(self.backend.connected_at) > connections, timeout=self.args.timeout)
+            await wait_for(lambda: plugin.supervisor.connected, timeout=self.args.timeout)
+            metrics = plugin.metrics
+            self.report(f"假死检测 存活期限 {self.args.liveness_deadline:.1f}s | "
+                        f"检测 {metrics.detect_latency.sum / max(1, metrics.detect_latency.count):7.3f}s | "
+                        f"恢复 {metrics.recover_latency.sum / max(1, metrics.recover_latency.count):7.3f}s | "
+                        f"卡住到重连 {self.backend.connected_at[-1] - stalled_at:7.3f}s")
+        finally:
+            await self.stop_plugin(plugin)
+            await proxy.stop()
+
+    async def bench_poll(self):
+        subscribers = self._subscribers(10)
+        plugin, context = await self.start_plugin(subscribers)
+        try:
+            not_modified_before = self.backend.not_modified
+            await self.backend.drop_push()
+            await wait_for(lambda: plugin.polling, timeout=self.args.timeout)
+            # 等轮询间隔退避到上限后再发布新兑换码，测量最坏情况下的延迟
+            await asyncio.sleep(self.args.poll_max_interval * 2)
+            polls, not_modified = plugin.metrics.polls.value, self.backend.not_modified - not_modified_before
+            self.backend.add_code("infinity", "POLLED")
+            published_at = time.monotonic()
+            await wait_for(lambda: context.messages >= 2 * len(subscribers), timeout=self.args.timeout)
+            delivered_at = max(times[-1] for times in context.sent.values())
+            idle_polls = polls
+            connections = len(self.backend.connected_at)
+            self.backend.block_push = False
+            await wait_for(lambda: len(self.backend.connected_at) > connections, timeout=self.args.timeout)
+            await wait_for(lambda: not plugin.polling, timeout=self.args.timeout)
+            self.report(f"轮询兜底 间隔 {self.args.poll_min_interval:.1f}-{self.args.poll_max_interval:.1f}s | "
+                        f"发布到送达 {delivered_at - published_at:7.3f}s | "
+                        f"空闲期请求 {idle_polls} 次，其中 304 {not_modified} 次 | 推送恢复后停止轮询")
+        finally:
+            await self.stop_plugin(plugin)
+
+    async def run(self):
+        skip = set(self.args.skip.split(",")) if self.args.skip else set()
+        await self.backend.start()
+        try:
+            if "broadcast" not in skip:
+                for count in self.args.subscribers:
+                    await self.bench_broadcast(count)
+            if "query" not in skip:
+                await self.bench_query()
+            if "reconnect" not in skip:
+                await self.bench_reconnect()
+            if "halfopen" not in skip:
+                await self.bench_halfopen()
+            if "poll" not in skip:
+                await self.bench_poll()
+        finally:
+            await self.backend.stop()
+        if self.args.output:
+            with open(self.args.output, "w", encoding="utf-8") as f:
+                f.write("\n".join(self.lines) + "\n")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="nikki5_code_tracker 离线基准测试")
+    parser.add_argument("--subscribers", default="10,1000,10000",
+                        type=lambda v: [int(n) for n in v.split(",")], help="广播测试的订阅者数量，逗号分隔")
+    parser.add_argument("--platforms", type=int, default=4, help="订阅者分布的平台数")
+    parser.add_argument("--send-latency", type=float, default=0.02, help="模拟 send_message 的平均延迟（秒）")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="模拟 send_message 的失败率")
+    parser.add_argument("--concurrency", type=int, default=main.BROADCAST_CONCURRENCY, help="广播并发数")
+    parser.add_argument("--platform-rate", type=float, default=2000.0,
+                        help="每个平台每秒最多消息数（默认放开限速，测量引擎本身的吞吐）")
+    parser.add_argument("--target-rate", type=float, default=1000.0, help="每个会话每秒最多消息数")
+    parser.add_argument("--coalesce-window", type=float, default=0.0, help="推送合并窗口（秒）")
+    parser.add_argument("--query-codes", type=int, default=8, help="查询测试中有效兑换码的数量")
+    parser.add_argument("--query-concurrency", type=int, default=100, help="并发查询数")
+    parser.add_argument("--query-duration", type=float, default=10.0, help="查询测试持续时间（秒）")
+    parser.add_argument("--outage", type=float, default=3.0, help="断线恢复测试中后端停机时长（秒）")
+    parser.add_argument("--heartbeat-interval", type=float, default=1.0, help="心跳间隔（秒）")
+    parser.add_argument("--liveness-deadline", type=float, default=3.0, help="假死判定的存活期限（秒）")
+    parser.add_argument("--reconnect-base-delay", type=float, default=0.5, help="重连退避的基准时间（秒）")
+    parser.add_argument("--poll-min-interval", type=float, default=0.5, help="轮询兜底的最短间隔（秒）")
+    parser.add_argument("--poll-max-interval", type=float, default=4.0, help="轮询兜底的最长间隔（秒）")
+    parser.add_argument("--no-conditional", action="store_true",
+                        help="替身兑换码接口不返回 ETag，测量不支持条件请求的后端下轮询的退避")
+    parser.add_argument("--timeout", type=float, default=600.0, help="单个场景的超时时间（秒）")
+    parser.add_argument("--skip", default="", help="跳过的场景：broadcast,query,reconnect,halfopen,poll")
+    parser.add_argument("--output", help="把结果另存到文件")
+    parser.add_argument("--verbose", action="store_true", help="输出插件日志")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if not args.verbose:
+        logging.getLogger(main.logger.name).setLevel(logging.WARNING)
+        logging.getLogger("aiohttp").setLevel(logging.WARNING)
+    random.seed(5)
+    asyncio.run(Harness(args).run())
@@ -8,15 +8,1643 @@ import asyncio
 import json
 import datetime
 import os
+import sys
 import socketio
 import time
 import hashlib
+import heapq
+import socket
+import sqlite3
+import threading
+import random
+from bisect import bisect_left
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass
+try:
+    import fcntl
+except ImportError:  # Windows 上没有 fcntl，只支持单节点，不加文件锁
+    fcntl = None
+
+# 后端服务地址（兑换码接口和 Socket.IO 推送），实际使用时应替换为正确的地址
+BACKEND_URL = "http://172.17.0.1:3000"
 
 # 使用Docker挂载的数据目录，确保数据持久化
 SUBSCRIBERS_FILE_PATH = "/AstrBot/data/subscribers.json"
+# 订阅变更日志：每次订阅/取消只追加一行，定期合并回 subscribers.json 快照
+SUBSCRIBERS_JOURNAL_PATH = "/AstrBot/data/subscribers.journal"
+SUBSCRIBERS_COMPACT_THRESHOLD = 500  # 日志超过多少条后合并为新快照
+# 插件状态数据库（推送发件箱等），同样放在持久化目录下
+PLUGIN_DB_PATH = "/AstrBot/data/nikki5_code_tracker.db"
+# Prometheus 文本格式的指标文件，可由 node_exporter 的 textfile collector 采集
+METRICS_FILE_PATH = "/AstrBot/data/nikki5_code_tracker.prom"
+METRICS_WRITE_INTERVAL = 30  # 指标文件写入间隔（秒）
+# 延迟直方图的分桶上界（秒）
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+# 全局变量：存储插件实例，用于重载时交接连接和清理旧连接
+# AstrBot 重载插件时会把本模块从 sys.modules 中移除再重新导入，模块级变量会被重置，
+# 所以实例表挂在 sys 上，保证新模块能找到旧实例
+_plugin_instances = getattr(sys, "_nikki5_code_tracker_instances", None)
+if _plugin_instances is None:
+    _plugin_instances = {}
+    sys._nikki5_code_tracker_instances = _plugin_instances
+
+# 重载交接：terminate 后保留连接一段时间，等待新实例接管；期间收到的推送先缓存
+HANDOVER_GRACE = 15          # 等待新实例接管的时长（秒），超时则真正断开
+HANDOVER_DRAIN_TIMEOUT = 30  # 新实例等待旧实例进行中的投递收尾的最长时间（秒）
+
+# 广播限速配置：保留 v1.0.13 的防封号节奏，但不再逐个订阅者串行发送
+BROADCAST_CONCURRENCY = 32  # 同时推送的订阅者数量
+PLATFORM_RATE = 5.0         # 每个平台每秒最多发送的消息数
+PLATFORM_BURST = 5          # 每个平台允许的突发消息数
+TARGET_RATE = 1.0           # 每个会话每秒最多发送的消息数（即同一会话两条消息间隔1秒）
+TARGET_BURST = 1            # 每个会话允许的突发消息数
+
+# 投递故障隔离：单次发送超时、有限次数的抖动退避重试，持续失败的会话暂停推送
+SEND_TIMEOUT = 15               # 单条消息发送超时（秒）
+SEND_RETRIES = 2                # 发送失败后的最多重试次数
+SEND_RETRY_BASE_DELAY = 1.0     # 重试退避的基准时间（秒），每次翻倍并加随机抖动
+PARK_AFTER_FAILURES = 3         # 连续多少次广播都送达失败后暂停向该会话推送
+PARK_DURATION = 24 * 3600       # 暂停推送多久后再试探一次（秒）
+
+# 后端HTTP请求配置：整个插件生命周期共用一个连接池
+HTTP_TIMEOUT = 10            # 单次请求总超时（秒）
+HTTP_CONNECT_TIMEOUT = 3     # 建立连接超时（秒）
+HTTP_MAX_CONNECTIONS = 8     # 连接池大小，同时也是并发请求上限
+HTTP_KEEPALIVE_TIMEOUT = 30  # 空闲连接保活时间（秒）
+HTTP_USER_AGENT = "NikkiCodeTracker/1.0.13"
+
+# 推送发件箱：待发送的推送先落盘，确认送达后再标记，重启后从未确认的位置继续
+OUTBOX_ACK_BATCH = 200        # 确认记录攒够多少条立即写盘
+OUTBOX_FLUSH_INTERVAL = 1.0   # 确认记录最长多久写一次盘（秒）
+OUTBOX_RETENTION = 7 * 86400  # 已确认的记录保留时长（秒）
+
+# 多节点部署：共享数据目录的多个 AstrBot 容器通过数据库中的租约选出唯一的推送节点
+LEADER_LEASE_TTL = 10        # 租约有效期（秒），推送节点失联后最多这么久由其他节点接替
+LEADER_RENEW_INTERVAL = 3    # 续约/竞选间隔（秒）
+
+# 已推送兑换码的去重账本：按首次出现时间排序，持久化后重连/重启也不会重复推送
+DEDUP_RETENTION = 30 * 86400  # 记录保留时长（秒）
+DEDUP_MAX_ENTRIES = 10000     # 内存中最多保留的记录数
+
+# Socket.IO 连接监管：应用层心跳检测假死连接，断线后按指数退避加随机抖动重连
+HEARTBEAT_EVENT = "heartbeat"   # 心跳事件名，后端对该事件回调确认（ack）即视为连接存活
+HEARTBEAT_INTERVAL = 15         # 心跳间隔（秒）
+HEARTBEAT_TIMEOUT = 10          # 单次心跳等待确认的超时（秒）
+LIVENESS_DEADLINE = 45          # 超过多久没有存活迹象（心跳确认或推送事件）判定连接假死（秒）
+RECONNECT_BASE_DELAY = 2.0      # 重连退避的基准时间（秒），每次失败翻倍并加随机抖动
+RECONNECT_MAX_DELAY = 120.0     # 重连退避的上限（秒）
+RECONNECT_STABLE_AFTER = 60     # 连接保持多久后才重置退避（秒），避免连上即断时反复快速重连
+
+# 重连后的补偿同步：向后端只请求上次同步之后新增的兑换码
+SYNC_OVERLAP = 60  # 请求时把高水位往前放宽的秒数，避免时钟误差漏掉边界上的兑换码
+
+# 推送合并：窗口内同一游戏到达的多个兑换码合并成一份摘要推送
+COALESCE_WINDOW = 3.0       # 合并窗口（秒），0 表示不合并
+MESSAGE_MAX_LENGTH = 1500   # 单条消息的最大长度，超过时拆分为多条
+
+# 推送不可用时的轮询兜底：用条件请求（ETag / Last-Modified）轮询兑换码接口，没有变化时间隔逐步加大
+POLL_MIN_INTERVAL = 15     # 轮询最短间隔（秒），也是推送断开后最迟多久开始轮询
+POLL_MAX_INTERVAL = 120    # 轮询最长间隔（秒），即轮询期间新兑换码的最大延迟
+
+# 兑换码过期提醒：过期前提醒订阅了该游戏的用户，过期后从本地状态中移除
+EXPIRY_REMINDER_LEAD = 24 * 3600   # 提前多久提醒（秒），0 表示不提醒
+EXPIRY_BATCH_WINDOW = 300          # 这段时间内陆续到点的提醒合并成一次推送（秒）
+EXPIRY_MAX_SLEEP = 3600            # 定时器单次最长睡眠（秒），系统时间被调整后也能及时纠正
+
+# 兑换码查询缓存：new_code 推送时主动失效，TTL 只作为兜底
+CODE_CACHE_TTL = 300  # 缓存有效期（秒）
+CODE_SITE_URL = "http://code.infinitynikki.top/"
+
+# 后端返回的兑换码过期时间格式
+CODE_TIME_FORMAT = "%Y/%m/%d %H:%M:%S"
+
+# 后端推送的游戏名与查询接口游戏类型的对应关系
+GAME_TYPES = {
+    "InfinityNikki": "infinity",
+    "ShiningNikki": "shining",
+    "DeepSpace": "deepspace",
+}
+# 订阅全部游戏的标记（旧版订阅者迁移后也是订阅全部游戏）
+ALL_GAMES = "*"
+
+
+class Counter:
+    """只增不减的计数器"""
+
+    __slots__ = ("value",)
+    kind = "counter"
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class Gauge:
+    """即时值，读取时调用回调函数"""
+
+    __slots__ = ("func",)
+    kind = "gauge"
+
+    def __init__(self, func):
+        self.func = func
+
+    @property
+    def value(self):
+        return self.func()
+
+
+class Histogram:
+    """固定分桶的延迟直方图，记录一次只需一次二分查找"""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+    kind = "histogram"
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """按分桶估算分位数（返回所在分桶的上界）"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class PluginMetrics:
+    """插件运行指标：延迟直方图、计数器和队列深度"""
+
+    def __init__(self):
+        self.registry = []
+        self.fetch_latency = self._add("nikki5_backend_fetch_seconds", "后端兑换码接口请求耗时", Histogram())
+        self.fetch_errors = self._add("nikki5_backend_fetch_errors_total", "后端兑换码接口请求失败次数", Counter())
+        self.delivery_latency = self._add(
+            "nikki5_delivery_latency_seconds", "从收到 new_code 到送达单个订阅者的耗时", Histogram())
+        self.broadcast_latency = self._add(
+            "nikki5_broadcast_last_delivery_seconds", "从收到 new_code 到送达最后一个订阅者的耗时", Histogram())
+        self.events = self._add("nikki5_new_code_events_total", "收到的 new_code 事件数", Counter())
+        self.dedup_hits = self._add("nikki5_dedup_hits_total", "被去重账本拦下的重复兑换码数", Counter())
+        self.deliveries = self._add("nikki5_deliveries_total", "成功送达的推送数", Counter())
+        self.send_failures = self._add("nikki5_send_failures_total", "推送失败数", Counter())
+        self.disconnects = self._add("nikki5_disconnects_total", "WebSocket 断开次数", Counter())
+        self.reconnects = self._add("nikki5_reconnect_attempts_total", "WebSocket 连接尝试次数", Counter())
+        self.polls = self._add("nikki5_poll_requests_total", "推送不可用时的轮询请求数", Counter())
+        self.polls_not_modified = self._add("nikki5_poll_not_modified_total", "轮询请求中返回 304 未变化的次数", Counter())
+        self.detect_latency = self._add(
+            "nikki5_connection_detect_seconds", "从最后一次确认存活到判定断线的耗时", Histogram())
+        self.recover_latency = self._add(
+            "nikki5_connection_recover_seconds", "从判定断线到重新连上的耗时", Histogram())
+
+    def _add(self, name, help_text, metric):
+        self.registry.append((name, help_text, metric))
+        return metric
+
+    def gauge(self, name, help_text, func):
+        """登记一个读取时计算的即时值"""
+        return self._add(name, help_text, Gauge(func))
+
+    def render_prometheus(self):
+        """输出 Prometheus 文本格式"""
+        lines = []
+        for name, help_text, metric in self.registry:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            if metric.kind == "histogram":
+                cumulative = 0
+                for bound, n in zip(metric.buckets, metric.counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{le="+Inf"}} {metric.count}')
+                lines.append(f"{name}_sum {metric.sum}")
+                lines.append(f"{name}_count {metric.count}")
+            else:
+                lines.append(f"{name} {metric.value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """管理员命令使用的简要文本"""
+        lines = []
+        for name, help_text, metric in self.registry:
+            if metric.kind == "histogram":
+                avg = metric.sum / metric.count if metric.count else 0.0
+                lines.append(f"{help_text}: 次数 {metric.count}，平均 {avg:.2f}s，"
+                             f"p50≤{metric.quantile(0.5)}s，p99≤{metric.quantile(0.99)}s")
+            else:
+                lines.append(f"{help_text}: {metric.value}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _write_file(path, text):
+        # 先写临时文件再原子替换，采集端不会读到写了一半的文件
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    async def write_textfile(self, path):
+        """把指标写入 Prometheus textfile"""
+        await asyncio.to_thread(self._write_file, path, self.render_prometheus())
+
+
+class TokenBucket:
+    """令牌桶限速器，按固定速率补充令牌"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_idle(self):
+        """令牌已补满，说明该桶近期没有被使用"""
+        self._refill()
+        return self.tokens >= self.capacity and not self._lock.locked()
+
+    async def acquire(self):
+        """获取一个令牌，令牌不足时等待"""
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+@dataclass
+class BroadcastReport:
+    """一次广播的统计结果"""
+    targets: int = 0
+    delivered: int = 0
+    failed: int = 0
+    started_at: float = 0.0             # 开始广播的时间（time.monotonic）
+    time_to_last_delivery: float = 0.0  # 从开始广播到最后一个订阅者送达的耗时（秒）
+
+
+class BroadcastScheduler:
+    """并发广播调度器：按平台和会话两级令牌桶限速，多个订阅者同时推送"""
+
+    def __init__(self, send_func, concurrency=BROADCAST_CONCURRENCY,
+                 platform_rate=PLATFORM_RATE, platform_burst=PLATFORM_BURST,
+                 target_rate=TARGET_RATE, target_burst=TARGET_BURST,
+                 send_timeout=SEND_TIMEOUT, retries=SEND_RETRIES, retry_base_delay=SEND_RETRY_BASE_DELAY):
+        self.send_func = send_func
+        self.concurrency = concurrency
+        self.send_timeout = send_timeout
+        self.retries = retries
+        self.retry_base_delay = retry_base_delay
+        self.platform_rate = platform_rate
+        self.platform_burst = platform_burst
+        self.target_rate = target_rate
+        self.target_burst = target_burst
+        self.platform_buckets = {}
+        self.target_buckets = {}
+
+    @staticmethod
+    def get_platform(target):
+        """从 unified_msg_origin（平台:消息类型:会话ID）中取出平台名"""
+        return target.split(":", 1)[0]
+
+    def _platform_bucket(self, target):
+        platform = self.get_platform(target)
+        bucket = self.platform_buckets.get(platform)
+        if bucket is None:
+            bucket = TokenBucket(self.platform_rate, self.platform_burst)
+            self.platform_buckets[platform] = bucket
+        return bucket
+
+    def _target_bucket(self, target):
+        bucket = self.target_buckets.get(target)
+        if bucket is None:
+            bucket = TokenBucket(self.target_rate, self.target_burst)
+            self.target_buckets[target] = bucket
+        return bucket
+
+    def _prune_buckets(self):
+        """清理已经空闲的会话令牌桶，避免字典无限增长"""
+        idle = [t for t, b in self.target_buckets.items() if b.is_idle()]
+        for target in idle:
+            del self.target_buckets[target]
+
+    async def _send(self, target, chain, target_bucket, platform_bucket):
+        """发送一条消息：每次尝试都有超时，失败后按抖动指数退避重试"""
+        for attempt in range(self.retries + 1):
+            # 先等会话令牌再等平台令牌，避免占用平台配额去等待单个会话
+            await target_bucket.acquire()
+            await platform_bucket.acquire()
+            try:
+                # 找不到会话对应的平台时 send_message 不抛异常，只返回 False
+                if await asyncio.wait_for(self.send_func(target, chain), self.send_timeout) is False:
+                    raise RuntimeError("没有找到会话对应的平台")
+                return
+            except Exception as e:
+                if attempt >= self.retries:
+                    raise
+                delay = random.uniform(0.5, 1.5) * self.retry_base_delay * (2 ** attempt)
+                logger.info(f"向 {target} 发送消息失败（{type(e).__name__}: {e}），{delay:.1f} 秒后重试")
+                await asyncio.sleep(delay)
+
+    async def _deliver(self, target, message_chains):
+        """按顺序向单个订阅者发送所有消息，已发送成功的消息不会因为后面的重试而重复发送"""
+        target_bucket = self._target_bucket(target)
+        platform_bucket = self._platform_bucket(target)
+        for chain in message_chains:
+            await self._send(target, chain, target_bucket, platform_bucket)
+
+    async def broadcast(self, targets, message_chains, is_cancelled=None, on_result=None):
+        """向所有订阅者推送消息，返回广播统计；on_result(target, ok, error) 在每个订阅者处理完后调用。
+        每个订阅者的失败只影响它自己，不会中断其他订阅者的推送"""
+        targets = list(targets)
+        start = time.monotonic()
+        report = BroadcastReport(targets=len(targets), started_at=start)
+        pending = iter(targets)
+
+        async def worker():
+            for target in pending:
+                if is_cancelled and is_cancelled():
+                    return
+                error = None
+                try:
+                    await self._deliver(target, message_chains)
+                    report.delivered += 1
+                    report.time_to_last_delivery = time.monotonic() - start
+                except Exception as e:
+                    error = f"{type(e).__name__}: {e}"
+                    report.failed += 1
+                    logger.error(f"向 {target} 推送消息失败: {error}")
+                if on_result:
+                    on_result(target, error is None, error)
+
+        workers = min(self.concurrency, len(targets))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+        self._prune_buckets()
+        return report
+
+
+class PluginDB:
+    """插件状态数据库：单个 SQLite 连接，所有读写都放到线程池里执行，不阻塞事件循环"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS plugin_state (
+            name TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+    """
+
+    def __init__(self, path=PLUGIN_DB_PATH):
+        self.path = path
+        self.conn = None
+        self._lock = threading.Lock()
+        self._schemas = [self.SCHEMA]
+
+    def add_schema(self, sql):
+        """登记建表语句，在首次连接时执行"""
+        self._schemas.append(sql)
+        if self.conn is not None:
+            with self._lock:
+                self.conn.executescript(sql)
+
+    def _connect(self):
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            for sql in self._schemas:
+                conn.executescript(sql)
+            self.conn = conn
+        return self.conn
+
+    def _call(self, func, args):
+        with self._lock:
+            return func(self._connect(), *args)
+
+    async def run(self, func, *args):
+        """在线程池中执行 func(conn, *args)"""
+        return await asyncio.to_thread(self._call, func, args)
+
+    @staticmethod
+    @contextmanager
+    def transaction(conn, immediate=False):
+        """显式事务：出错时回滚，共享连接不会停留在未结束的事务里，之后的 BEGIN 也不会失败
+
+        immediate=True 时一开始就取得写锁，先读后写的事务不会在升级写锁时与其他进程冲突。
+        """
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _get_state(conn, name):
+        row = conn.execute("SELECT value FROM plugin_state WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def _set_state(conn, name, value):
+        conn.execute("INSERT OR REPLACE INTO plugin_state (name, value) VALUES (?, ?)", (name, json.dumps(value)))
+
+    async def get_state(self, name, default=None):
+        """读取一个持久化的状态值"""
+        value = await self.run(self._get_state, name)
+        return default if value is None else value
+
+    async def set_state(self, name, value):
+        """写入一个持久化的状态值（需可 JSON 序列化）"""
+        await self.run(self._set_state, name, value)
+
+    def close(self):
+        with self._lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+
+class LeaseLostError(Exception):
+    """推送节点租约已经失效或被其他节点接替"""
+
+
+class LeaderLease:
+    """共享数据库上的领导者租约：同一时间只有一个节点负责推送
+
+    每次换人持有时令牌（fencing token）加一。写入发件箱时在同一事务里校验令牌，
+    失去租约的旧节点即使还在运行（例如容器被暂停后恢复），也无法再发起新的推送。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS leader_lease (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            token INTEGER NOT NULL,
+            expires_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, db, node_id, name="broadcast", ttl=LEADER_LEASE_TTL):
+        self.db = db
+        self.db.add_schema(self.SCHEMA)
+        self.node_id = node_id
+        self.name = name
+        self.ttl = ttl
+        self.token = None       # 持有租约时的令牌
+        self.valid_until = 0.0  # 本地认为租约有效的截止时间（time.monotonic()）
+        self.holder = None      # 最近一次看到的持有者
+
+    @property
+    def is_leader(self):
+        return self.token is not None and time.monotonic() < self.valid_until
+
+    @staticmethod
+    def _acquire(conn, name, node_id, now, ttl):
+        with PluginDB.transaction(conn, immediate=True):
+            row = conn.execute(
+                "SELECT holder, token, expires_at FROM leader_lease WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                token = 1
+            elif row[0] == node_id:
+                token = row[1]
+            elif row[2] <= now:
+                token = row[1] + 1
+            else:
+                return None, row[0]
+            conn.execute("INSERT OR REPLACE INTO leader_lease (name, holder, token, expires_at) VALUES (?, ?, ?, ?)",
+                         (name, node_id, token, now + ttl))
+        return token, node_id
+
+    async def renew(self):
+        """竞选或续约，返回当前是否为推送节点"""
+        started = time.monotonic()
+        token, self.holder = await self.db.run(self._acquire, self.name, self.node_id, time.time(), self.ttl)
+        self.token = token
+        # 从发起请求时算起，保证本地判断不会比数据库中的租约晚过期
+        self.valid_until = started + self.ttl if token is not None else 0.0
+        return self.is_leader
+
+    @staticmethod
+    def _release(conn, name, node_id, token):
+        conn.execute("UPDATE leader_lease SET expires_at = 0 WHERE name = ? AND holder = ? AND token = ?",
+                     (name, node_id, token))
+
+    async def release(self):
+        """主动让出租约，其他节点下一次竞选即可接替"""
+        if self.token is None:
+            return
+        token, self.token, self.valid_until = self.token, None, 0.0
+        await self.db.run(self._release, self.name, self.node_id, token)
+
+    def fence(self):
+        """返回在写事务中校验令牌的函数，令牌失效时抛出 LeaseLostError"""
+        name, node_id, token = self.name, self.node_id, self.token
+
+        def check(conn):
+            row = conn.execute(
+                "SELECT 1 FROM leader_lease WHERE name = ? AND holder = ? AND token = ? AND expires_at > ?",
+                (name, node_id, token, time.time())).fetchone()
+            if row is None:
+                raise LeaseLostError(f"令牌 {token} 已失效")
+        return check
+
+
+class Outbox:
+    """持久化推送发件箱：先记录待投递的（订阅者, 消息），送达后批量确认"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS outbox_broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            label TEXT NOT NULL,
+            messages TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS outbox_deliveries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            broadcast_id INTEGER NOT NULL,
+            target TEXT NOT NULL,
+            acked_at REAL,
+            ok INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS outbox_pending ON outbox_deliveries(acked_at, broadcast_id);
+    """
+
+    def __init__(self, db, ack_batch=OUTBOX_ACK_BATCH, flush_interval=OUTBOX_FLUSH_INTERVAL):
+        self.db = db
+        self.db.add_schema(self.SCHEMA)
+        self.ack_batch = ack_batch
+        self.flush_interval = flush_interval
+        self.pending_acks = []
+        self.local_broadcasts = set()  # 本实例写入的广播ID，恢复时只接手之前实例遗留的投递
+        self._flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    @staticmethod
+    def _enqueue(conn, label, messages, targets, fence, also):
+        now = time.time()
+        with PluginDB.transaction(conn, immediate=True):
+            if fence is not None:
+                fence(conn)
+            cur = conn.execute(
+                "INSERT INTO outbox_broadcasts (label, messages, created_at) VALUES (?, ?, ?)",
+                (label, json.dumps(messages, ensure_ascii=False), now))
+            broadcast_id = cur.lastrowid
+            conn.executemany(
+                "INSERT INTO outbox_deliveries (broadcast_id, target) VALUES (?, ?)",
+                ((broadcast_id, target) for target in targets))
+            rows = conn.execute(
+                "SELECT id, target FROM outbox_deliveries WHERE broadcast_id = ?", (broadcast_id,)).fetchall()
+            if also is not None:
+                also(conn)
+        return broadcast_id, {target: delivery_id for delivery_id, target in rows}
+
+    async def enqueue(self, label, messages, targets, fence=None, also=None):
+        """一次事务写入整批投递任务，返回 {订阅者: 投递ID}；
+        fence(conn) 在同一事务中校验推送节点令牌，also(conn) 在同一事务中写入其他相关记录"""
+        broadcast_id, deliveries = await self.db.run(
+            self._enqueue, label, list(messages), list(targets), fence, also)
+        self.local_broadcasts.add(broadcast_id)
+        return deliveries
+
+    def ack(self, delivery_id, ok=True):
+        """确认一次投递；确认记录先缓存在内存中，批量写盘"""
+        self.pending_acks.append((time.time(), 1 if ok else 0, delivery_id))
+        if len(self.pending_acks) >= self.ack_batch:
+            asyncio.create_task(self.flush())
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    @staticmethod
+    def _write_acks(conn, acks):
+        with PluginDB.transaction(conn):
+            conn.executemany("UPDATE outbox_deliveries SET acked_at = ?, ok = ? WHERE id = ?", acks)
+
+    async def flush(self):
+        """把内存中的确认记录写入数据库"""
+        async with self._flush_lock:
+            if not self.pending_acks:
+                return
+            acks, self.pending_acks = self.pending_acks, []
+            try:
+                await self.db.run(self._write_acks, acks)
+            except Exception as e:
+                # 写盘失败时放回队列，下次再试
+                self.pending_acks = acks + self.pending_acks
+                logger.error(f"写入推送确认记录失败: {e}")
+
+    @staticmethod
+    def _load_pending(conn, exclude):
+        rows = conn.execute(
+            "SELECT b.id, b.label, b.messages, d.id, d.target "
+            "FROM outbox_deliveries d JOIN outbox_broadcasts b ON b.id = d.broadcast_id "
+            "WHERE d.acked_at IS NULL ORDER BY d.broadcast_id, d.id").fetchall()
+        broadcasts = {}
+        for broadcast_id, label, messages, delivery_id, target in rows:
+            if broadcast_id in exclude:
+                continue
+            if broadcast_id not in broadcasts:
+                broadcasts[broadcast_id] = (label, json.loads(messages), {})
+            broadcasts[broadcast_id][2][target] = delivery_id
+        return list(broadcasts.values())
+
+    async def load_pending(self):
+        """读取所有未确认的投递，按广播分组返回 [(标签, 消息列表, {订阅者: 投递ID})]"""
+        return await self.db.run(self._load_pending, set(self.local_broadcasts))
+
+    @staticmethod
+    def _purge(conn, before):
+        with PluginDB.transaction(conn):
+            conn.execute(
+                "DELETE FROM outbox_deliveries WHERE broadcast_id IN "
+                "(SELECT id FROM outbox_broadcasts WHERE created_at < ?) AND acked_at IS NOT NULL", (before,))
+            conn.execute(
+                "DELETE FROM outbox_broadcasts WHERE created_at < ? AND id NOT IN "
+                "(SELECT broadcast_id FROM outbox_deliveries)", (before,))
+
+    async def purge(self, retention=OUTBOX_RETENTION):
+        """清理过期的已确认记录"""
+        await self.db.run(self._purge, time.time() - retention)
+
+
+class SubscriberStore:
+    """订阅者存储：按游戏记录订阅并维护 游戏->订阅者 倒排索引；
+    变更追加写入日志，定期以原子替换的方式合并为快照，磁盘读写都不在事件循环中执行；
+    多个节点共享数据目录时，追加和合并持有日志文件锁，读取持有共享锁"""
+
+    def __init__(self, snapshot_path, journal_path, compact_threshold=SUBSCRIBERS_COMPACT_THRESHOLD):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path
+        self.lock_path = f"{journal_path}.lock"
+        self.compact_threshold = compact_threshold
+        self.subscriptions = {}       # 订阅者 -> 订阅的游戏类型集合，ALL_GAMES 表示全部游戏
+        self.index = {}               # 游戏类型 -> 订阅者集合
+        self.snapshot_version = None  # 已加载快照的 (mtime_ns, size)，变化说明快照被重写过
+        self.journal_offset = 0       # 已应用到的日志位置
+        self.journal_entries = 0      # 快照之后的日志条数
+        self.own_appends = set()      # 本进程追加、但位于 journal_offset 之后的日志行起始位置
+        self._lock = asyncio.Lock()
+
+    @property
+    def subscribers(self):
+        """所有订阅者（订阅了任意游戏）"""
+        return self.subscriptions.keys()
+
+    def games_of(self, umo):
+        """订阅者订阅的游戏类型集合，未订阅返回空集合"""
+        return self.subscriptions.get(umo, set())
+
+    def subscribers_of(self, game_type):
+        """订阅了某个游戏的订阅者；未知的游戏只推送给订阅了全部游戏的用户"""
+        targets = self.index.get(ALL_GAMES, set())
+        game_subscribers = self.index.get(game_type)
+        if game_subscribers:
+            targets = targets | game_subscribers
+        return targets
+
+    @staticmethod
+    def _merge(current, op, games):
+        """计算一次订阅/取消之后的游戏集合，返回空集合表示完全取消订阅"""
+        games = set(games) if games else {ALL_GAMES}
+        if op == "add":
+            merged = current | games
+            return {ALL_GAMES} if ALL_GAMES in merged else merged
+        if ALL_GAMES in games:
+            return set()
+        if ALL_GAMES in current:
+            current = set(GAME_TYPES.values())
+        return current - games
+
+    def _set_games(self, subscriptions, index, umo, games):
+        for game in subscriptions.get(umo, ()):
+            if game not in games:
+                index[game].discard(umo)
+        for game in games:
+            index.setdefault(game, set()).add(umo)
+        if games:
+            subscriptions[umo] = games
+        else:
+            subscriptions.pop(umo, None)
+
+    def _apply(self, subscriptions, index, entries):
+        for entry in entries:
+            op = entry.get("op")
+            if op in ("add", "remove"):
+                umo = entry["umo"]
+                merged = self._merge(subscriptions.get(umo, set()), op, entry.get("games"))
+                self._set_games(subscriptions, index, umo, merged)
+
+    def _lock_files(self, exclusive=True):
+        """取得跨进程的日志文件锁（会阻塞，需在线程中调用），关闭返回的文件即释放"""
+        f = open(self.lock_path, "a")
+        if fcntl is not None:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            except BaseException:
+                f.close()
+                raise
+        return f
+
+    @staticmethod
+    def _file_version(path):
+        try:
+            st = os.stat(path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _read_snapshot(self):
+        version = self._file_version(self.snapshot_path)
+        subscriptions = {}
+        if version is not None:
+            with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, list):
+                # 旧版 subscribers.json 只是订阅者列表，迁移为订阅全部游戏
+                subscriptions = {umo: {ALL_GAMES} for umo in data}
+            else:
+                subscriptions = {umo: set(games) for umo, games in data.items() if games}
+        return subscriptions, version
+
+    def _read_journal(self, offset, skip=()):
+        """从 offset 开始读取完整的日志行，未写完的最后一行留到下次读取；skip 为要跳过的行起始位置"""
+        entries = []
+        try:
+            with open(self.journal_path, "rb") as f:
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            return entries, 0
+        end = data.rfind(b"\n") + 1
+        position = offset
+        for line in data[:end].split(b"\n")[:-1]:
+            start, position = position, position + len(line) + 1
+            if start in skip:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                logger.error(f"跳过损坏的订阅日志记录: {line[:100]}")
+        return entries, offset + end
+
+    def _load(self):
+        # 共享锁保证读到的快照和日志属于同一次合并
+        with self._lock_files(exclusive=False):
+            subscriptions, version = self._read_snapshot()
+            entries, offset = self._read_journal(0)
+        index = {}
+        for umo, games in subscriptions.items():
+            for game in games:
+                index.setdefault(game, set()).add(umo)
+        self._apply(subscriptions, index, entries)
+        return subscriptions, index, version, offset, len(entries)
+
+    async def load(self):
+        """完整加载快照和日志"""
+        async with self._lock:
+            subscriptions, index, version, offset, count = await asyncio.to_thread(self._load)
+            self.subscriptions = subscriptions
+            self.index = index
+            self.snapshot_version = version
+            self.journal_offset = offset
+            self.own_appends = set()
+            self.journal_entries = count
+        return len(self.subscriptions)
+
+    def _journal_size(self):
+        try:
+            return os.path.getsize(self.journal_path)
+        except FileNotFoundError:
+            return 0
+
+    def _read_changes(self, version, offset, skip):
+        """快照没有被重写过时返回 offset 之后的日志，否则返回 None"""
+        with self._lock_files(exclusive=False):
+            if self._file_version(self.snapshot_path) != version or self._journal_size() < offset:
+                return None
+            return self._read_journal(offset, skip)
+
+    async def refresh(self):
+        """只应用上次加载之后的变更，快照被其他进程重写过时才完整重新加载，返回应用的变更条数"""
+        async with self._lock:
+            # 本进程自己追加的行已经生效并计数，跳过
+            changes = await asyncio.to_thread(
+                self._read_changes, self.snapshot_version, self.journal_offset, frozenset(self.own_appends))
+            if changes is not None:
+                entries, offset = changes
+                self._apply(self.subscriptions, self.index, entries)
+                self.journal_offset = offset
+                self.own_appends = {start for start in self.own_appends if start >= offset}
+                self.journal_entries += len(entries)
+                return len(entries)
+        count = len(self.subscriptions)
+        await self.load()
+        return abs(len(self.subscriptions) - count)
+
+    def _append(self, entry):
+        """追加一行日志，返回这一行在文件中的起止位置"""
+        line = (json.dumps(entry, ensure_ascii=False) + "\n").encode("utf-8")
+        with self._lock_files(), open(self.journal_path, "ab") as f:
+            start = f.tell()
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        return start, start + len(line)
+
+    async def _record(self, op, umo, games):
+        entry = {"op": op, "umo": umo, "ts": time.time()}
+        if games:
+            entry["games"] = sorted(games)
+        async with self._lock:
+            start, end = await asyncio.to_thread(self._append, entry)
+            # 自己追加的变更已经在内存中生效，refresh 时不再重复应用
+            if start == self.journal_offset:
+                self.journal_offset = end
+            else:
+                # 前面还有其他进程追加、尚未读取的日志，读取位置保持不动，只记下这一行
+                self.own_appends.add(start)
+            self.journal_entries += 1
+            if self.journal_entries >= self.compact_threshold:
+                await self._compact()
+
+    async def _update(self, op, umo, games):
+        current = self.games_of(umo)
+        merged = self._merge(current, op, games)
+        if merged == current:
+            return False
+        self._set_games(self.subscriptions, self.index, umo, merged)
+        await self._record(op, umo, games)
+        return True
+
+    async def add(self, umo, games=None):
+        """订阅指定游戏（不指定则订阅全部游戏），没有变化时返回 False"""
+        return await self._update("add", umo, games)
+
+    async def remove(self, umo, games=None):
+        """取消订阅指定游戏（不指定则全部取消），没有变化时返回 False"""
+        return await self._update("remove", umo, games)
+
+    def _write_snapshot(self, subscriptions):
+        # 先写临时文件再原子替换，进程中途退出也不会留下写了一半的快照
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(subscriptions, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+        # 快照已经包含全部变更，清空日志
+        with open(self.journal_path, "w", encoding="utf-8"):
+            pass
+        return self._file_version(self.snapshot_path)
+
+    async def _compact(self):
+        """把日志合并为新快照（调用方需持有锁）"""
+        try:
+            # 从读取日志到清空日志一直持有文件锁，其他进程这期间的追加会等到合并之后
+            lock = await asyncio.to_thread(self._lock_files)
+        except Exception as e:
+            logger.error(f"合并订阅日志失败: {str(e)}")
+            return
+        try:
+            # 先吸收其他进程追加的日志，避免合并时丢失
+            entries, _ = await asyncio.to_thread(
+                self._read_journal, self.journal_offset, frozenset(self.own_appends))
+            self._apply(self.subscriptions, self.index, entries)
+            snapshot = {umo: sorted(games) for umo, games in self.subscriptions.items()}
+            self.snapshot_version = await asyncio.to_thread(self._write_snapshot, snapshot)
+            self.journal_offset = 0
+            self.own_appends = set()
+            self.journal_entries = 0
+            logger.info(f"订阅日志已合并为快照，共 {len(self.subscriptions)} 个订阅者")
+        except Exception as e:
+            logger.error(f"合并订阅日志失败: {str(e)}")
+        finally:
+            lock.close()
+
+
+class TargetHealth:
+    """按会话记录连续推送失败次数；持续失败（被踢出群、会话已删除等）的会话暂停推送，过一段时间再试探"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS target_health (
+            target TEXT PRIMARY KEY,
+            failures INTEGER NOT NULL,
+            last_error TEXT,
+            parked_at REAL
+        );
+    """
+
+    def __init__(self, db, park_after=PARK_AFTER_FAILURES, park_duration=PARK_DURATION):
+        self.db = db
+        self.db.add_schema(self.SCHEMA)
+        self.park_after = park_after
+        self.park_duration = park_duration
+        self.failures = {}  # 会话 -> (连续失败次数, 最后一次错误, 暂停时间)
+        self.dirty = set()  # 等待写盘的会话
+
+    def is_parked(self, target, now=None):
+        """是否处于暂停推送状态；暂停期满后放行一次试探"""
+        state = self.failures.get(target)
+        if state is None or state[2] is None:
+            return False
+        if now is None:
+            now = time.time()
+        return now - state[2] < self.park_duration
+
+    def parked(self):
+        """所有暂停推送的会话 {会话: (连续失败次数, 最后一次错误, 暂停时间)}"""
+        now = time.time()
+        return {target: state for target, state in self.failures.items() if self.is_parked(target, now)}
+
+    def record(self, target, ok, error=None):
+        """记录一次广播的送达结果，返回该会话是否因此被暂停"""
+        if ok:
+            if target in self.failures:
+                del self.failures[target]
+                self.dirty.add(target)
+            return False
+
+        count = self.failures.get(target, (0, None, None))[0] + 1
+        parked_at = time.time() if count >= self.park_after else None
+        self.failures[target] = (count, error, parked_at)
+        self.dirty.add(target)
+        return parked_at is not None
+
+    def reset(self, target=None):
+        """清除某个会话（不指定则全部）的失败记录，恢复推送"""
+        targets = [target] if target is not None else list(self.failures)
+        for t in targets:
+            if self.failures.pop(t, None) is not None:
+                self.dirty.add(t)
+
+    @staticmethod
+    def _write(conn, rows, removed):
+        with PluginDB.transaction(conn):
+            conn.executemany(
+                "INSERT OR REPLACE INTO target_health (target, failures, last_error, parked_at) VALUES (?, ?, ?, ?)",
+                rows)
+            conn.executemany("DELETE FROM target_health WHERE target = ?", removed)
+
+    async def flush(self):
+        """把变化的失败记录写入数据库"""
+        if not self.dirty:
+            return
+        dirty, self.dirty = self.dirty, set()
+        rows = [(t, *self.failures[t]) for t in dirty if t in self.failures]
+        removed = [(t,) for t in dirty if t not in self.failures]
+        try:
+            await self.db.run(self._write, rows, removed)
+        except Exception as e:
+            self.dirty |= dirty
+            logger.error(f"写入推送失败记录失败: {e}")
+
+    @staticmethod
+    def _load(conn):
+        return conn.execute("SELECT target, failures, last_error, parked_at FROM target_health").fetchall()
+
+    async def load(self):
+        """从数据库恢复失败记录"""
+        rows = await self.db.run(self._load)
+        self.failures = {target: (failures, last_error, parked_at) for target, failures, last_error, parked_at in rows}
+        return len(self.failures)
+
+
+class DedupLedger:
+    """按时间排序的去重账本：记录已推送的（游戏, 兑换码），插入和过期都是均摊 O(1)"""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS dedup_ledger (
+            game TEXT NOT NULL,
+            key TEXT NOT NULL,
+            seen_at REAL NOT NULL,
+            PRIMARY KEY (game, key)
+        );
+        CREATE INDEX IF NOT EXISTS dedup_seen_at ON dedup_ledger(seen_at);
+    """
+
+    def __init__(self, db, retention=DEDUP_RETENTION, max_entries=DEDUP_MAX_ENTRIES):
+        self.db = db
+        self.db.add_schema(self.SCHEMA)
+        self.retention = retention
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # (游戏, 兑换码) -> 首次出现时间，按插入顺序即时间顺序排列
+        self.unsaved = set()          # 只在内存中登记、还没有落盘的记录
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _expire(self, now):
+        """从最旧的一端弹出过期或超出容量的记录"""
+        entries = self.entries
+        deadline = now - self.retention
+        while entries:
+            seen_at = next(iter(entries.values()))
+            if seen_at >= deadline and len(entries) <= self.max_entries:
+                break
+            self.unsaved.discard(entries.popitem(last=False)[0])
+
+    def seen(self, game, key):
+        """是否已经推送过"""
+        return (game, key) in self.entries
+
+    def is_saved(self, game, key):
+        """是否已经登记并落盘，进程退出后也不会再推送"""
+        return (game, key) in self.entries and (game, key) not in self.unsaved
+
+    def reserve(self, game, key):
+        """只在内存中登记，已经登记过时返回 False；落盘由 writer 随发件箱在同一事务中完成"""
+        if (game, key) in self.entries:
+            return False
+        now = time.time()
+        # 同步写入内存，保证同一时刻收到的重复事件也能被挡住
+        self.entries[(game, key)] = now
+        self.unsaved.add((game, key))
+        self._expire(now)
+        return True
+
+    def forget(self, keys):
+        """撤销还没有落盘的登记（例如失去推送节点租约、没能写入发件箱时）"""
+        for key in keys:
+            self.entries.pop(key, None)
+            self.unsaved.discard(key)
+
+    def saved(self, keys):
+        """writer 所在的事务已经提交"""
+        self.unsaved.difference_update(keys)
+
+    def writer(self, keys):
+        """返回在调用方事务中写入这些记录的函数 func(conn)"""
+        now = time.time()
+        rows = [(game, key, self.entries.get((game, key), now)) for game, key in keys]
+        deadline = now - self.retention
+
+        def write(conn):
+            conn.executemany("INSERT OR IGNORE INTO dedup_ledger (game, key, seen_at) VALUES (?, ?, ?)", rows)
+            conn.execute("DELETE FROM dedup_ledger WHERE seen_at < ?", (deadline,))
+        return write
+
+    async def persist(self, keys):
+        """单独一个事务把记录落盘"""
+        write = self.writer(keys)
+
+        def run(conn):
+            with PluginDB.transaction(conn):
+                write(conn)
+        try:
+            await self.db.run(run)
+        except Exception as e:
+            logger.error(f"写入去重记录失败: {e}")
+            return
+        self.saved(keys)
+
+    async def record(self, game, key):
+        """登记一个兑换码并立即落盘，已经登记过时返回 False"""
+        if not self.reserve(game, key):
+            return False
+        await self.persist([(game, key)])
+        return True
+
+    @staticmethod
+    def _load(conn, deadline, limit):
+        rows = conn.execute(
+            "SELECT game, key, seen_at FROM dedup_ledger WHERE seen_at >= ? ORDER BY seen_at DESC LIMIT ?",
+            (deadline, limit)).fetchall()
+        rows.reverse()
+        return rows
+
+    async def load(self):
+        """从数据库恢复最近的记录"""
+        now = time.time()
+        rows = await self.db.run(self._load, now - self.retention, self.max_entries)
+        # 内存中可能已有交接接手或刚登记的记录，合并后按时间重新排序，_expire 才能从最旧的一端过期
+        merged = dict(self.entries)
+        for game, key, seen_at in rows:
+            merged[(game, key)] = min(seen_at, merged.get((game, key), seen_at))
+        self.entries = OrderedDict(sorted(merged.items(), key=lambda item: item[1]))
+        self._expire(now)
+        return len(self.entries)
+
+
+class CodeCoalescer:
+    """合并窗口：同一游戏在窗口内到达的兑换码合并为一次推送"""
+
+    def __init__(self, flush_func, window=COALESCE_WINDOW):
+        self.flush_func = flush_func
+        self.window = window
+        self.pending = {}  # 游戏类型 -> 等待推送的兑换码列表
+        self.timers = {}   # 游戏类型 -> 窗口计时任务
+
+    def __len__(self):
+        return sum(len(items) for items in self.pending.values())
+
+    async def add(self, game_type, item):
+        """加入一个兑换码，窗口期结束后统一推送"""
+        if self.window <= 0:
+            await self.flush_func(game_type, [item])
+            return
+        self.pending.setdefault(game_type, []).append(item)
+        if game_type not in self.timers:
+            self.timers[game_type] = asyncio.create_task(self._flush_later(game_type))
+
+    def adopt(self, pending):
+        """接手另一个合并器中等待推送的兑换码（重载交接时使用）"""
+        for game_type, items in pending.items():
+            self.pending.setdefault(game_type, []).extend(items)
+            if game_type not in self.timers:
+                self.timers[game_type] = asyncio.create_task(self._flush_later(game_type))
+
+    def cancel_timers(self):
+        """取消所有窗口计时，不推送"""
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+
+    async def _flush_later(self, game_type):
+        await asyncio.sleep(max(self.window, 0))
+        await self._flush(game_type)
+
+    async def _flush(self, game_type):
+        self.timers.pop(game_type, None)
+        items = self.pending.pop(game_type, None)
+        if items:
+            await self.flush_func(game_type, items)
+
+    async def flush_all(self):
+        """立即推送所有等待中的兑换码（终止前调用，保证窗口中的兑换码连同去重记录进入发件箱）"""
+        for timer in list(self.timers.values()):
+            timer.cancel()
+        await asyncio.gather(*(self._flush(game_type) for game_type in list(self.pending)))
+
+
+def pack_lines(lines, limit=MESSAGE_MAX_LENGTH, sep="\n"):
+    """把多行文本尽量少地打包成多条消息，每条不超过 limit 个字符"""
+    messages = []
+    current = ""
+    for line in lines:
+        if current and len(current) + len(sep) + len(line) > limit:
+            messages.append(current)
+            current = line
+        else:
+            current = f"{current}{sep}{line}" if current else line
+    if current:
+        messages.append(current)
+    return messages
+
+
+def parse_end_time(end_time_str):
+    """将兑换码过期时间解析为时间戳（按本地时间）"""
+    return datetime.datetime.strptime(end_time_str, CODE_TIME_FORMAT).timestamp()
+
+
+class CodeIndex:
+    """预解析的兑换码索引：过期时间只解析一次，按过期时间排序，过期的从队首弹出"""
+
+    __slots__ = ("entries",)
+
+    def __init__(self, json_data):
+        entries = []
+        for code_item in json_data:
+            try:
+                # 检查是否包含必要的字段
+                if 'code' in code_item and 'end' in code_item:
+                    entries.append((parse_end_time(code_item['end']), code_item['code']))
+            except Exception:
+                continue
+        entries.sort(key=lambda entry: entry[0])
+        self.entries = deque(entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def prune(self, now=None):
+        """丢弃已过期的兑换码，只检查队首，不重新扫描整个列表"""
+        if now is None:
+            now = time.time()
+        entries = self.entries
+        while entries and entries[0][0] <= now:
+            entries.popleft()
+
+    def valid_codes(self, now=None):
+        """返回仍然有效的兑换码，按过期时间从早到晚排列"""
+        self.prune(now)
+        return [code for _, code in self.entries]
+
+
+class ExpiryScheduler:
+    """兑换码过期调度：所有提醒和过期时间放在一个最小堆里，只用一个定时任务睡到最近的截止时间
+
+    堆中的条目不删除，兑换码过期时间变化后旧条目在出堆时按 tracked 校验丢弃（惰性删除）。
+    """
+
+    REMIND = 0
+    EXPIRE = 1
+
+    def __init__(self, on_due, lead=EXPIRY_REMINDER_LEAD, batch_window=EXPIRY_BATCH_WINDOW):
+        self.on_due = on_due  # async on_due(reminders, expired)，参数均为 [(游戏, 兑换码, 过期时间戳)]
+        self.lead = lead
+        self.batch_window = batch_window
+        self.heap = []        # (触发时间, 类型, 游戏, 兑换码, 过期时间戳)
+        self.tracked = {}     # (游戏, 兑换码) -> 过期时间戳
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def __len__(self):
+        return len(self.tracked)
+
+    def track(self, game, code, end_ts):
+        """登记一个兑换码的过期时间；已经进入提醒时段的兑换码立即提醒（是否已提醒过由调用方去重）"""
+        now = time.time()
+        key = (game, code)
+        if end_ts <= now or self.tracked.get(key) == end_ts:
+            return
+        self.tracked[key] = end_ts
+        earliest = self.heap[0][0] if self.heap else None
+        remind_at = end_ts - self.lead
+        if self.lead > 0:
+            heapq.heappush(self.heap, (max(remind_at, now), self.REMIND, game, code, end_ts))
+        heapq.heappush(self.heap, (end_ts, self.EXPIRE, game, code, end_ts))
+        if earliest is None or self.heap[0][0] < earliest:
+            # 新的截止时间更早，叫醒定时任务重新计算睡眠时长
+            self.wakeup.set()
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+    def adopt(self, other):
+        """接手旧实例的调度状态"""
+        self.heap = other.heap
+        self.tracked = other.tracked
+
+    def rearm(self):
+        """按登记的过期时间重建整个堆，重新安排所有提醒（例如刚成为推送节点时）"""
+        tracked, self.tracked, self.heap = self.tracked, {}, []
+        for (game, code), end_ts in tracked.items():
+            self.track(game, code, end_ts)
+
+    def _pop_due(self, now):
+        reminders, expired = [], []
+        heap = self.heap
+        # 批处理窗口内即将到点的提醒一并取出，合并成一次推送
+        while heap and heap[0][0] <= now + self.batch_window:
+            if heap[0][1] == self.EXPIRE and heap[0][0] > now:
+                break
+            _, kind, game, code, end_ts = heapq.heappop(heap)
+            if self.tracked.get((game, code)) != end_ts:
+                continue
+            if kind == self.EXPIRE:
+                del self.tracked[(game, code)]
+                expired.append((game, code, end_ts))
+            else:
+                reminders.append((game, code, end_ts))
+        return reminders, expired
+
+    async def _run(self):
+        while True:
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+            delay = self.heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=min(delay, EXPIRY_MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            reminders, expired = self._pop_due(time.time())
+            if reminders or expired:
+                try:
+                    await self.on_due(reminders, expired)
+                except Exception as e:
+                    logger.error(f"处理兑换码过期提醒时出错: {e}")
+
+
+class CodeCache:
+    """按游戏类型缓存兑换码列表，并把同一游戏的并发未命中合并为一次后端请求"""
+
+    def __init__(self, fetch_func, ttl=CODE_CACHE_TTL):
+        self.fetch_func = fetch_func
+        self.ttl = ttl
+        self.entries = {}     # 游戏类型 -> (数据, 获取时间)
+        self.inflight = {}    # 游戏类型 -> 正在进行的请求
+        self.generation = {}  # 游戏类型 -> 失效次数，用于丢弃失效前发起的请求结果
+
+    async def get(self, game_type):
+        """获取兑换码列表，缓存未命中时发起（或等待已有的）后端请求"""
+        entry = self.entries.get(game_type)
+        if entry and time.monotonic() - entry[1] < self.ttl:
+            return entry[0]
+
+        future = self.inflight.get(game_type)
+        if future is None:
+            future = asyncio.ensure_future(self._load(game_type))
+            self.inflight[game_type] = future
+        # shield 保证单个查询被取消时不会影响其他等待同一请求的查询
+        return await asyncio.shield(future)
+
+    async def _load(self, game_type):
+        generation = self.generation.get(game_type, 0)
+        try:
+            data = await self.fetch_func(game_type)
+        finally:
+            if self.inflight.get(game_type) is asyncio.current_task():
+                del self.inflight[game_type]
+
+        # 请求失败时 fetch_func 返回错误信息字符串，不缓存；请求期间被失效的结果也不缓存
+        if not isinstance(data, str) and self.generation.get(game_type, 0) == generation:
+            self.entries[game_type] = (data, time.monotonic())
+        return data
+
+    def invalidate(self, game_type):
+        """使某个游戏的缓存失效，之后的查询会重新请求后端"""
+        self.generation[game_type] = self.generation.get(game_type, 0) + 1
+        self.entries.pop(game_type, None)
+        # 正在进行的请求可能早于新兑换码，让后续查询重新发起请求
+        self.inflight.pop(game_type, None)
+
+
+class CodeReplyCache:
+    """按（查询, 兑换码列表版本）缓存排版好的回复分页，兑换码没有变化时重复查询不再重新排版"""
+
+    def __init__(self, render_func):
+        self.render_func = render_func
+        self.entries = {}  # 查询键 -> (版本, 分页)
+
+    @staticmethod
+    def _version(indexes):
+        # 缓存失效或重新请求后是新的 CodeIndex 对象；兑换码过期弹出后数量变化
+        for index in indexes:
+            index.prune()
+        return [(index, len(index)) for index in indexes]
+
+    def get(self, key, games, indexes):
+        """返回分页列表；indexes 为与 games 一一对应的 CodeIndex"""
+        version = self._version(indexes)
+        entry = self.entries.get(key)
+        if entry and len(entry[0]) == len(version) and all(
+                a is b and m == n for (a, m), (b, n) in zip(entry[0], version)):
+            return entry[1]
+        pages = self.render_func(games, indexes)
+        self.entries[key] = (version, pages)
+        return pages
+
+
+class ConnectionSupervisor:
+    """Socket.IO 连接监管状态机，唯一持有 AsyncClient
+
+    状态依次为 idle → connecting → connected →（断线）backoff → connecting …，stop() 后为 stopped。
+    客户端和事件处理器只创建一次，重连时复用；只有假死连接断不干净时才换一个新客户端。
+    客户端自带的自动重连关闭，重连节奏完全由这里决定。
+    """
+
+    def __init__(self, url, heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+                 liveness_deadline=LIVENESS_DEADLINE, base_delay=RECONNECT_BASE_DELAY,
+                 max_delay=RECONNECT_MAX_DELAY, stable_after=RECONNECT_STABLE_AFTER):
+        self.url = url
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.liveness_deadline = liveness_deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stable_after = stable_after
+
+        self.handlers = {}        # 事件名 -> 当前插件实例的处理函数，交接时整体替换
+        self.sio = self._new_client()
+        self.discarding = set()   # 正在后台关闭的旧客户端
+        self.on_up = None         # 连接建立回调 on_up(recover_seconds)，首次连接时参数为 None
+        self.on_down = None       # 判定断线回调 on_down(detect_seconds, reason)
+        self.on_attempt = None    # 每次发起连接时的回调
+
+        self.state = "idle"
+        self.task = None
+        self.disconnected = asyncio.Event()
+        self.failures = 0             # 连续失败次数，决定下一次退避时长
+        self.next_attempt_at = None   # 退避结束的时间（time.monotonic()）
+        self.last_alive = None        # 最近一次确认连接存活的时间
+        self.down_since = None        # 判定断线的时间，重新连上后用于计算恢复耗时
+        self.heartbeat_acked = False  # 当前连接上后端是否确认过心跳
+        self.heartbeat_rtt = None     # 最近一次心跳往返耗时
+        self.last_down_reason = None
+
+    @property
+    def connected(self):
+        return self.state == "connected" and self.sio.connected
+
+    def bind(self, handlers, on_up=None, on_down=None, on_attempt=None):
+        """（重新）绑定事件处理器和回调；Socket.IO 上只注册一次转发函数，交接时不动客户端"""
+        for event in handlers:
+            if event not in self.handlers:
+                self.sio.on(event, self._dispatcher(event))
+        self.handlers = dict(handlers)
+        self.on_up = on_up
+        self.on_down = on_down
+        self.on_attempt = on_attempt
+
+    def _new_client(self):
+        """创建客户端并注册断线处理和所有事件的转发函数"""
+        sio = socketio.AsyncClient(reconnection=False)
+
+        async def on_disconnect(*args):
+            # 被丢弃的旧客户端稍后才断开，不能当成当前连接断线
+            if sio is self.sio:
+                self.disconnected.set()
+
+        sio.on("disconnect", on_disconnect)
+        for event in self.handlers:
+            sio.on(event, self._dispatcher(event))
+        return sio
+
+    def _replace_client(self):
+        """换用新客户端，旧客户端不等关闭握手，在后台强制关闭
+
+        对端不再响应时 disconnect() 会一直等 Engine.IO 的关闭握手，中途取消又会让客户端停在
+        disconnecting 状态，之后每次 connect() 都报 "Client is not in a disconnected state"。
+        """
+        old = self.sio
+        self.sio = self._new_client()
+        task = asyncio.create_task(self._discard(old))
+        self.discarding.add(task)
+        task.add_done_callback(self.discarding.discard)
+
+    async def _discard(self, sio):
+        eio = sio.eio
+        for task in (eio.read_loop_task, eio.write_loop_task):
+            if task is not None and not task.done():
+                task.cancel()
+        try:
+            await asyncio.wait_for(eio.disconnect(abort=True), timeout=self.heartbeat_timeout)
+        except Exception as e:
+            logger.info(f"关闭假死连接时的错误（可以忽略）: {e}")
+        if not eio.external_http and eio.http is not None and not eio.http.closed:
+            await eio.http.close()
+
+    def _dispatcher(self, event):
+        async def dispatch(*args):
+            # 收到任何推送都说明连接还活着
+            self.last_alive = time.monotonic()
+            handler = self.handlers.get(event)
+            if handler is not None:
+                return await handler(*args)
+        return dispatch
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """停止监管并断开连接"""
+        self.state = "stopped"
+        if self.task and not self.task.done() and self.task is not asyncio.current_task():
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.sio.connected:
+            await self.sio.disconnect()
+        if self.discarding:
+            await asyncio.gather(*self.discarding, return_exceptions=True)
+
+    @staticmethod
+    def _notify(callback, *args):
+        if callback is None:
+            return
+        try:
+            callback(*args)
+        except Exception as e:
+            logger.error(f"连接状态回调出错: {e}")
+
+    async def _run(self):
+        while self.state != "stopped":
+            self.state = "connecting"
+            self._notify(self.on_attempt)
+            self.disconnected.clear()
+            if self.sio.connected or self.sio.eio.state != "disconnected":
+                self._replace_client()
+            try:
+                await self.sio.connect(self.url)
+            except Exception as e:
+                logger.error(f"WebSocket连接失败: {e}")
+                self.failures += 1
+                await self._backoff()
+                continue
+
+            connected_at = time.monotonic()
+            self.state = "connected"
+            self.last_alive = connected_at
+            self.heartbeat_acked = False
+            recover_seconds = connected_at - self.down_since if self.down_since is not None else None
+            self.down_since = None
+            logger.info("WebSocket连接成功")
+            self._notify(self.on_up, recover_seconds)
+
+            reason = await self._watch()
+            if self.state == "stopped":
+                break
+            now = time.monotonic()
+            self.down_since = now
+            self.last_down_reason = reason
+            logger.info(f"WebSocket连接断开（{reason}），距最后一次确认存活 {now - self.last_alive:.1f} 秒")
+            self._notify(self.on_down, now - self.last_alive, reason)
+
+            # 连接保持足够久才算恢复正常，否则继续加大退避
+            self.failures = 1 if now - connected_at >= self.stable_after else self.failures + 1
+            await self._backoff()
+
+    async def _watch(self):
+        """连接期间在后台定时心跳，返回断线原因"""
+        beat = asyncio.create_task(self._heartbeat_loop())
+        try:
+            while True:
+                # 后端确认过心跳时等到存活期限为止，否则交给 Engine.IO 自身的 ping 超时检测
+                timeout = self.heartbeat_interval
+                if self.heartbeat_acked:
+                    timeout = min(timeout, max(0.0, self.last_alive + self.liveness_deadline - time.monotonic()))
+                try:
+                    await asyncio.wait_for(self.disconnected.wait(), timeout=timeout)
+                    return "服务器断开或传输层超时"
+                except asyncio.TimeoutError:
+                    pass
+                if self.heartbeat_acked and time.monotonic() - self.last_alive > self.liveness_deadline:
+                    self._replace_client()
+                    return f"超过 {self.liveness_deadline} 秒没有心跳确认"
+        finally:
+            beat.cancel()
+
+    async def _heartbeat_loop(self):
+        # 独立于 _watch 运行，后端迟迟不确认心跳时也不耽误发现断线
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            await self._heartbeat()
+
+    async def _heartbeat(self):
+        sent_at = time.monotonic()
+        try:
+            await self.sio.call(HEARTBEAT_EVENT, timeout=self.heartbeat_timeout)
+        except Exception:
+            # 超时或连接已断开，由存活期限判断
+            return
+        now = time.monotonic()
+        self.heartbeat_rtt = now - sent_at
+        self.heartbeat_acked = True
+        self.last_alive = now
+
+    async def _backoff(self):
+        if self.state == "stopped":
+            return
+        self.state = "backoff"
+        delay = min(self.max_delay, self.base_delay * 2 ** (self.failures - 1)) * random.uniform(0.5, 1.0)
+        self.next_attempt_at = time.monotonic() + delay
+        logger.info(f"{delay:.1f} 秒后重连WebSocket（连续失败 {self.failures} 次）")
+        await asyncio.sleep(delay)
+        self.next_attempt_at = None
+
+    def describe(self):
+        """管理员命令使用的连接状态文本"""
+        names = {"idle": "未启动", "connecting": "连接中", "connected": "已连接",
+                 "backoff": "等待重连", "stopped": "已停止"}
+        lines = [f"WebSocket连接: {names.get(self.state, self.state)}"]
+        now = time.monotonic()
+        if self.state == "connected":
+            lines.append(f"心跳: {'已确认' if self.heartbeat_acked else '后端未确认，依赖传输层超时'}"
+                         + (f"，往返 {self.heartbeat_rtt * 1000:.0f}ms" if self.heartbeat_rtt is not None else ""))
+            if self.last_alive is not None:
+                lines.append(f"距最后一次确认存活: {now - self.last_alive:.1f} 秒")
+        if self.next_attempt_at is not None:
+            lines.append(f"下次重连: {max(0.0, self.next_attempt_at - now):.1f} 秒后（连续失败 {self.failures} 次）")
+        if self.last_down_reason:
+            lines.append(f"最近一次断线原因: {self.last_down_reason}")
+        return "\n".join(lines)
 
-# 全局变量：存储插件实例，用于清理旧连接
-_plugin_instances = {}
 
 @register("nikki5_code_tracker", "Lynn", "一个普通的兑换码查询插件", "1.0.13")
 class MyPlugin(Star):
@@ -27,21 +1655,57 @@ class MyPlugin(Star):
         self.instance_id = hashlib.md5(f"{time.time()}_{id(self)}".encode()).hexdigest()[:8]
         logger.info(f"插件实例 {self.instance_id} 初始化")
         
-        # 清理旧实例的连接
-        self._cleanup_old_instances()
+        self.event_counter = 0  # 添加事件计数器
         
-        # 注册当前实例
-        _plugin_instances[self.instance_id] = self
+        # API基础URL
+        self.base_url = f"{BACKEND_URL}/api/codes"
+        self.broadcaster = BroadcastScheduler(self.context.send_message)
         
-        self.event_counter = 0  # 添加事件计数器
-        self.last_notification_time = {}  # 记录最后通知时间，用于去重
+        # 共享HTTP连接池，在 _delayed_init 中创建，terminate 时关闭
+        self.http_session = None
+        self.http_semaphore = asyncio.Semaphore(HTTP_MAX_CONNECTIONS)
+        self.code_cache = CodeCache(self.fetch_code_index)
+        self.reply_cache = CodeReplyCache(self.render_code_pages)
+        self.expiry = ExpiryScheduler(self.on_codes_due)
         
-        # API基础URL，实际使用时应替换为正确的地址
-        self.base_url = "http://172.17.0.1:3000/api/codes"
-        self.subscribers = set()
+        # 持久化推送发件箱，重启/重载后从未确认的投递继续
+        self.db = PluginDB(PLUGIN_DB_PATH)
+        self.outbox = Outbox(self.db)
+        self.dedup = DedupLedger(self.db)
+        self.target_health = TargetHealth(self.db)
+        self.sync_lock = asyncio.Lock()  # 同一时间只运行一次补偿同步
+        self.coalescer = CodeCoalescer(self.broadcast_codes)
+        
+        # 多节点部署时只有持有租约的节点推送，其他节点保持连接作为热备
+        self.lease = LeaderLease(self.db, f"{socket.gethostname()}:{os.getpid()}")
+        self.leading = False        # 上一次竞选的结果，用于发现角色变化
+        self.election_task = None
+        
+        # 推送断开时的轮询兜底
+        self.polling = False
+        self.poll_interval = POLL_MIN_INTERVAL
+        self.poll_validators = {}   # 游戏类型 -> 条件请求的校验值
+        self.sync_pending = {}      # 游戏类型 -> (待推进的高水位, 兑换码列表)，这些兑换码都落盘后才推进
+        self.poll_task = None
+        
+        # 运行指标，定期写入 Prometheus textfile，也可以用 /插件指标 查看
+        self.inflight_deliveries = 0  # 已写入发件箱、还没有结果的投递数
+        self.metrics = PluginMetrics()
+        self.metrics.gauge("nikki5_inflight_deliveries", "正在推送的投递数", lambda: self.inflight_deliveries)
+        self.metrics.gauge("nikki5_outbox_pending_acks", "等待写盘的投递确认数", lambda: len(self.outbox.pending_acks))
+        self.metrics.gauge("nikki5_coalescer_pending_codes", "合并窗口中等待推送的兑换码数", lambda: len(self.coalescer))
+        self.metrics.gauge("nikki5_subscribers", "订阅者数量", lambda: len(self.subscribers))
+        self.metrics.gauge("nikki5_parked_targets", "因持续失败暂停推送的会话数", lambda: len(self.target_health.parked()))
+        self.metrics.gauge("nikki5_tracked_codes", "过期调度中跟踪的兑换码数", lambda: len(self.expiry))
+        self.metrics.gauge("nikki5_leader", "本节点是否为推送节点", lambda: 1 if self.lease.is_leader else 0)
+        self.metrics.gauge("nikki5_polling", "是否正在用轮询代替推送", lambda: 1 if self.polling else 0)
+        self.metrics.gauge("nikki5_websocket_connected", "WebSocket 是否已连接",
+                           lambda: 1 if self.supervisor and self.supervisor.connected else 0)
+        self.metrics_task = None
         
         # 使用全局配置的数据文件路径
         self.data_file = SUBSCRIBERS_FILE_PATH
+        self.subscriber_store = SubscriberStore(self.data_file, SUBSCRIBERS_JOURNAL_PATH)
         
         # 确保配置目录存在
         os.makedirs(os.path.dirname(self.data_file), exist_ok=True)
@@ -49,150 +1713,647 @@ class MyPlugin(Star):
         # 打印路径信息便于调试
         logger.info(f"订阅文件保存路径: {self.data_file}")
         
-        # 加载已有订阅者
-        self.load_subscribers()
+        # 在后台加载已有订阅者，不阻塞事件循环
+        self.subscribers_loaded = asyncio.create_task(self.load_subscribers())
 
-        # 初始化Socket.IO客户端
-        self.sio = None
-        self.reconnect_task = None  # 跟踪重连任务
-        self.reconnecting = False  # 重连状态标志
+        # Socket.IO 连接监管，在 _delayed_init 中创建或从旧实例接手
+        self.supervisor = None
         self.is_terminated = False  # 标记是否已终止
         
+        # 重载交接相关状态
+        self.active_broadcasts = set()  # 进行中的广播任务
+        self.handover_buffer = None     # 等待交接期间缓存的 new_code 事件
+        self.handover_timer = None      # 等待交接超时后真正释放资源的任务
+        self.drain_task = None          # 终止后等待进行中投递收尾的任务
+        self.previous_drained = None    # 被接管的旧实例的收尾任务
+        self.adopted_events = []        # 从旧实例接手的缓存事件
+        
+        # 接管旧实例的连接和状态（无法接管时清理旧连接）
+        self._take_over_old_instances()
+        
+        # 注册当前实例
+        _plugin_instances[self.instance_id] = self
+        
         # 延迟初始化连接，避免立即连接冲突
         asyncio.create_task(self._delayed_init())
     
+    @property
+    def subscribers(self):
+        """当前订阅者集合"""
+        return self.subscriber_store.subscribers
+    
     async def _delayed_init(self):
         """延迟初始化WebSocket连接"""
-        # 等待一小段时间，确保旧连接被清理
-        await asyncio.sleep(2)
+        adopted = self.supervisor is not None
+        if not adopted:
+            # 没有接管到连接时等待一小段时间，确保旧连接被清理
+            await asyncio.sleep(2)
         if not self.is_terminated:
-            await self.init_websocket()
-    
-    def _cleanup_old_instances(self):
-        """清理旧的插件实例连接"""
-        instances_to_remove = []
-        for instance_id, instance in _plugin_instances.items():
-            if instance != self:
-                logger.info(f"清理旧插件实例 {instance_id}")
-                try:
-                    # 异步清理旧实例
+            self.get_http_session()
+            await self.subscribers_loaded
+            if not adopted:
+                await self.load_target_health()
+            # 旧实例进行中的投递收尾后，再竞选推送节点，由推送节点读出遗留的未送达投递
+            if self.previous_drained:
+                await asyncio.wait([self.previous_drained], timeout=HANDOVER_DRAIN_TIMEOUT)
+            await self.elect(catch_up=False)
+            if not self.lease.is_leader:
+                logger.info(f"节点 {self.lease.node_id} 作为热备节点运行，当前推送节点: {self.lease.holder}")
+            self.election_task = asyncio.create_task(self._hold_leadership())
+            self.poll_task = asyncio.create_task(self._poll_while_push_down())
+            self.expiry.start()
+            if not adopted:
+                # 拉取一次各游戏的兑换码列表，登记现有兑换码的过期时间
+                asyncio.create_task(self.track_code_expiries())
+            self.metrics_task = asyncio.create_task(self._write_metrics_periodically())
+            
+            # 交接期间旧实例缓存的推送
+            events, self.adopted_events = self.adopted_events, []
+            for data, received_at in events:
+                await self.handle_new_code(data, received_at=received_at)
+            
+            if adopted:
+                logger.info(f"实例 {self.instance_id} 沿用旧实例的WebSocket连接")
+            else:
+                self.init_websocket()
+    
+    async def elect(self, catch_up=True):
+        """竞选或续约推送节点；刚成为推送节点时接手去重账本和发件箱中遗留的投递"""
+        try:
+            await self.lease.renew()
+        except Exception as e:
+            logger.error(f"竞选推送节点失败: {e}")
+        is_leader = self.lease.is_leader
+        was_leader, self.leading = self.leading, is_leader
+        if is_leader and not was_leader:
+            logger.info(f"节点 {self.lease.node_id} 成为推送节点（令牌 {self.lease.token}）")
+            # 之前的推送节点登记过的兑换码和没送完的投递，以及其他节点上新增的订阅
+            await self.load_dedup()
+            await self.refresh_subscribers()
+            # 热备期间到点的过期提醒没有发出，重新安排，已提醒过的由去重账本挡住
+            self.expiry.rearm()
+            pending = await self.load_outbox()
+            if pending:
+                asyncio.create_task(self.resume_outbox(pending))
+            if catch_up:
+                # 补上没有推送节点期间错过的兑换码
+                asyncio.create_task(self.catch_up_sync())
+        elif was_leader and not is_leader:
+            logger.warning(f"节点 {self.lease.node_id} 失去推送节点租约，当前持有者: {self.lease.holder}")
+    
+    async def _hold_leadership(self):
+        """定期续约；热备节点在推送节点失联、租约过期后接替"""
+        while not self.is_terminated:
+            await asyncio.sleep(LEADER_RENEW_INTERVAL)
+            if not self.is_terminated:
+                await self.elect()
+    
+    async def _write_metrics_periodically(self):
+        """定期把指标写入 Prometheus textfile"""
+        while not self.is_terminated:
+            await asyncio.sleep(METRICS_WRITE_INTERVAL)
+            try:
+                await self.metrics.write_textfile(METRICS_FILE_PATH)
+            except Exception as e:
+                logger.error(f"写入指标文件失败: {e}")
+    
+    def _take_over_old_instances(self):
+        """接管旧插件实例：连接还活着就直接沿用，无法交接的旧实例则清理其连接"""
+        for instance_id, instance in list(_plugin_instances.items()):
+            if instance is self:
+                continue
+            _plugin_instances.pop(instance_id, None)
+            try:
+                if hasattr(instance, "_handover"):
+                    logger.info(f"接管旧插件实例 {instance_id}")
+                    self._adopt(instance._handover())
+                else:
+                    # 旧版本的实例不支持交接，异步清理
+                    logger.info(f"清理旧插件实例 {instance_id}")
                     asyncio.create_task(instance._force_cleanup())
-                    instances_to_remove.append(instance_id)
-                except Exception as e:
-                    logger.error(f"清理旧实例时出错: {e}")
-                    instances_to_remove.append(instance_id)
+            except Exception as e:
+                logger.error(f"接管旧实例 {instance_id} 时出错: {e}")
+    
+    def _prepare_handover(self):
+        """停止处理新任务，准备把连接交给新实例；之后收到的推送先缓存"""
+        self.is_terminated = True
         
-        # 从全局字典中移除已清理的实例
-        for instance_id in instances_to_remove:
-            _plugin_instances.pop(instance_id, None)
+        # 取消指标写入任务和续约任务（租约在释放资源时让出，交接时留给新实例）
+        if self.metrics_task and not self.metrics_task.done():
+            self.metrics_task.cancel()
+        if self.election_task and not self.election_task.done():
+            self.election_task.cancel()
+        if self.poll_task and not self.poll_task.done():
+            self.poll_task.cancel()
+        self.expiry.stop()
+        
+        if self.handover_buffer is None:
+            self.handover_buffer = []
+        if self.drain_task is None:
+            self.drain_task = asyncio.create_task(self._drain())
+    
+    def _handover(self):
+        """把连接和内存状态交给重载后的新实例"""
+        self._prepare_handover()
+        if self.handover_timer and not self.handover_timer.done():
+            self.handover_timer.cancel()
+        
+        self.coalescer.cancel_timers()
+        supervisor = self.supervisor
+        if supervisor is not None and supervisor.state == "stopped":
+            supervisor = None
+        state = {
+            "supervisor": supervisor,
+            "http_session": self.http_session,
+            "dedup_entries": self.dedup.entries,
+            "dedup_unsaved": self.dedup.unsaved,
+            "sync_pending": self.sync_pending,
+            "target_failures": self.target_health.failures,
+            "coalescer_pending": self.coalescer.pending,
+            "buffered_events": self.handover_buffer,
+            "drained": self.drain_task,
+            "event_counter": self.event_counter,
+            "lease": (self.lease.token, self.lease.valid_until),
+            "expiry": self.expiry,
+        }
+        
+        # 这些资源已经属于新实例，旧实例不再关闭它们
+        self.supervisor = None
+        self.http_session = None
+        self.coalescer.pending = {}
+        self.handover_buffer = None
+        asyncio.create_task(self._close_after_drain())
+        return state
+    
+    def _adopt(self, state):
+        """接手旧实例交出的连接和状态"""
+        if state.get("supervisor") is not None:
+            # 重新绑定事件处理器，之后的事件都由新实例处理；连接断开过的监管器会自己继续重连
+            self.supervisor = state["supervisor"]
+            self.bind_supervisor()
+        if state["http_session"] is not None and not state["http_session"].closed:
+            self.http_session = state["http_session"]
+        self.dedup.entries = state["dedup_entries"]
+        self.dedup.unsaved = state.get("dedup_unsaved", set())
+        self.sync_pending = state.get("sync_pending", {})
+        self.target_health.failures = state["target_failures"]
+        self.coalescer.adopt(state["coalescer_pending"])
+        self.adopted_events = state["buffered_events"] or []
+        self.previous_drained = state["drained"]
+        self.event_counter = state["event_counter"]
+        # 同一进程的节点ID不变，直接沿用旧实例的租约
+        self.lease.token, self.lease.valid_until = state.get("lease", (None, 0.0))
+        if state.get("expiry") is not None:
+            self.expiry.adopt(state["expiry"])
     
-    async def _force_cleanup(self):
-        """强制清理当前实例的连接"""
+    async def _drain(self):
+        """等待进行中的广播停下（终止后不再开始新的投递），并把确认记录写盘"""
+        active = [task for task in self.active_broadcasts if task is not asyncio.current_task()]
+        if active:
+            await asyncio.wait(active, timeout=HANDOVER_DRAIN_TIMEOUT)
+        await self.outbox.flush()
+        await self.target_health.flush()
+    
+    async def _close_after_drain(self):
+        """交接完成后，等进行中的投递收尾再关闭旧实例的数据库"""
         try:
-            self.is_terminated = True
-            
-            # 取消重连任务
-            if self.reconnect_task and not self.reconnect_task.done():
-                self.reconnect_task.cancel()
-                
-            # 断开WebSocket连接
-            if self.sio and self.sio.connected:
-                await self.sio.disconnect()
-                logger.info(f"实例 {self.instance_id} WebSocket连接已强制关闭")
-                
+            await self.drain_task
+        except Exception as e:
+            logger.error(f"实例 {self.instance_id} 收尾时出错: {e}")
+        self.db.close()
+    
+    async def _release_after_grace(self):
+        """等待新实例接管，超时说明插件被卸载，真正释放资源"""
+        await asyncio.sleep(HANDOVER_GRACE)
+        logger.info(f"实例 {self.instance_id} 没有被新实例接管，关闭连接")
+        await self._release()
+    
+    async def _release(self):
+        """释放连接、HTTP 会话和数据库；缓存的推送和合并窗口中的兑换码写入发件箱留给下次启动"""
+        _plugin_instances.pop(self.instance_id, None)
+        
+        # 断开WebSocket连接
+        if self.supervisor:
+            try:
+                await self.supervisor.stop()
+                logger.info(f"实例 {self.instance_id} WebSocket连接已关闭")
+            except Exception as e:
+                logger.error(f"关闭WebSocket连接时出错: {e}")
+        
+        await self.drain_task
+        events, self.handover_buffer = self.handover_buffer or [], None
+        for data, received_at in events:
+            await self.handle_new_code(data, received_at=received_at)
+        await self.coalescer.flush_all()
+        await self.outbox.flush()
+        await self.target_health.flush()
+        try:
+            # 主动让出租约，热备节点不必等租约过期
+            await self.lease.release()
         except Exception as e:
-            logger.error(f"强制清理实例 {self.instance_id} 时出错: {e}")
+            logger.error(f"让出推送节点租约时出错: {e}")
+        self.db.close()
+        
+        # 关闭共享HTTP连接池
+        await self.close_http_session()
+    
+    def init_websocket(self):
+        """创建连接监管并开始连接"""
+        if self.is_terminated:
+            return
+        self.supervisor = ConnectionSupervisor(
+            BACKEND_URL, heartbeat_interval=HEARTBEAT_INTERVAL, heartbeat_timeout=HEARTBEAT_TIMEOUT,
+            liveness_deadline=LIVENESS_DEADLINE, base_delay=RECONNECT_BASE_DELAY,
+            max_delay=RECONNECT_MAX_DELAY, stable_after=RECONNECT_STABLE_AFTER)
+        self.bind_supervisor()
+        self.supervisor.start()
+    
+    def bind_supervisor(self):
+        """把连接事件交给当前实例处理"""
+        self.supervisor.bind({"new_code": self.on_new_code},
+                             on_up=self.on_connection_up,
+                             on_down=self.on_connection_down,
+                             on_attempt=self.metrics.reconnects.inc)
+    
+    def on_connection_up(self, recover_seconds):
+        if recover_seconds is not None:
+            self.metrics.recover_latency.observe(recover_seconds)
+        if not self.is_terminated:
+            logger.info(f"实例 {self.instance_id} 已连接到WebSocket服务器")
+            # 补上断线期间错过的兑换码
+            asyncio.create_task(self.catch_up_sync())
+    
+    def on_connection_down(self, detect_seconds, reason):
+        self.metrics.disconnects.inc()
+        self.metrics.detect_latency.observe(detect_seconds)
     
-    async def init_websocket(self):
-        """初始化WebSocket连接"""
+    async def on_new_code(self, data):
         if self.is_terminated:
+            # 等待新实例接管期间的推送先缓存，交接后由新实例处理
+            if self.handover_buffer is not None:
+                self.handover_buffer.append((data, time.monotonic()))
             return
             
-        self.sio = socketio.AsyncClient()
-        self.setup_socketio()
-        await self.connect_websocket()
+        self.event_counter += 1
+        self.metrics.events.inc()
+        logger.info(f"实例 {self.instance_id} 收到第 {self.event_counter} 个WebSocket事件: {data}")
+        await self.handle_new_code(data, received_at=time.monotonic())
     
-    def setup_socketio(self):
-        """设置Socket.IO客户端事件处理器"""
-        
-        @self.sio.event
-        async def connect():
-            if not self.is_terminated:
-                logger.info(f"实例 {self.instance_id} 已连接到WebSocket服务器")
-        
-        @self.sio.event
-        async def disconnect():
-            if not self.is_terminated:
-                logger.info(f"实例 {self.instance_id} 与WebSocket服务器断开连接")
-                # 确保重置连接状态
-                self.reconnecting = False
-                # 延迟重连，给服务器时间完全启动
-                if not self.reconnect_task or self.reconnect_task.done():
-                    self.schedule_reconnect(5)
-
-        @self.sio.on('new_code')
-        async def on_new_code(data):
-            if self.is_terminated:
+    async def handle_new_code(self, data, received_at=None):
+        """处理一条新兑换码：去重后推送给订阅了该游戏的用户；received_at 为收到事件的 time.monotonic()"""
+        try:
+            # 解析接收到的数据
+            game_name = data.get('game_name')
+            key = data.get('key')
+            reward = data.get('reward')
+            time_str = data.get('time')
+            url = data.get('url')
+
+            if not game_name or not key:
+                logger.error(f"收到无效的兑换码数据: {data}")
                 return
-                
-            self.event_counter += 1
-            logger.info(f"实例 {self.instance_id} 收到第 {self.event_counter} 个WebSocket事件: {data}")
             
+            game_type = self.get_game_type(game_name)
+            
+            # 新兑换码到达，查询缓存立即失效
+            self.code_cache.invalidate(game_type)
             try:
-                # 解析接收到的数据
-                game_name = data.get('game_name')
-                key = data.get('key')
-                reward = data.get('reward')
-                time_str = data.get('time')
-                url = data.get('url')
-
-                if not game_name or not key:
-                    logger.error(f"收到无效的兑换码数据: {data}")
+                end_ts = parse_end_time(time_str) if time_str else None
+            except (TypeError, ValueError):
+                end_ts = None
+            
+            # 多节点部署时只由推送节点推送，热备节点接替后靠补偿同步补上
+            if not self.lease.is_leader:
+                if end_ts:
+                    self.expiry.track(game_type, key, end_ts)
+                return
+            
+            # 按（游戏, 兑换码）去重，已经推送过或正在合并窗口中的不再推送；
+            # 去重记录在窗口结束、写入发件箱时才落盘，窗口期内进程退出时补偿同步还能补上
+            if not self.dedup.reserve(game_type, key):
+                self.metrics.dedup_hits.inc()
+                logger.info(f"忽略重复通知: {game_name} - {key}")
+                return
+            
+            if end_ts:
+                if end_ts - time.time() <= self.expiry.lead:
+                    # 推送里已经带了有效期，快过期的新兑换码不再单独提醒
+                    await self.dedup.record(f"{game_type}:expiring", key)
+                self.expiry.track(game_type, key, end_ts)
+            
+            logger.info(f"实例 {self.instance_id} 处理新兑换码: {game_name} - {key}")
+            
+            # 进入合并窗口，窗口内同一游戏的兑换码合并成一次推送
+            await self.coalescer.add(game_type, {'key': key, 'reward': reward, 'time': time_str, 'url': url,
+                                                 'received_at': received_at or time.monotonic()})
+            
+        except Exception as e:
+            logger.error(f"处理新兑换码时出错: {str(e)}")
+    
+    async def track_code_expiries(self):
+        """拉取各游戏的兑换码列表（经过查询缓存），列表中的兑换码会登记到过期调度"""
+        await asyncio.gather(*(self.code_cache.get(g) for g in GAME_TYPES.values()))
+    
+    def render_expiry_reminder(self, game_type, items):
+        """生成过期提醒消息：items 为 [(兑换码, 过期时间戳)]"""
+        lines = [f"⏰ {self.get_game_display_name(game_type)} 有 {len(items)} 个兑换码即将过期，还没兑换的抓紧啦！"]
+        for code, end_ts in sorted(items, key=lambda item: item[1]):
+            lines.append(f"{code}（{datetime.datetime.fromtimestamp(end_ts).strftime(CODE_TIME_FORMAT)} 过期）")
+        return pack_lines(lines)
+    
+    async def on_codes_due(self, reminders, expired):
+        """过期调度到点：过期的兑换码从查询缓存中移除，即将过期的推送提醒给订阅了该游戏的用户"""
+        for game_type in {game for game, _, _ in expired}:
+            entry = self.code_cache.entries.get(game_type)
+            if entry and isinstance(entry[0], CodeIndex):
+                entry[0].prune()
+        if expired:
+            logger.info(f"{len(expired)} 个兑换码已过期: {', '.join(code for _, code, _ in expired)}")
+        
+        if not reminders or self.is_terminated or not self.lease.is_leader:
+            return
+        by_game = {}
+        for game_type, code, end_ts in reminders:
+            # 提醒也记入去重账本，重启或换推送节点后不会重复提醒
+            if self.dedup.reserve(f"{game_type}:expiring", code):
+                by_game.setdefault(game_type, []).append((code, end_ts))
+        for game_type, items in by_game.items():
+            texts = self.render_expiry_reminder(game_type, items)
+            label = f"{game_type} 即将过期 - {', '.join(code for code, _ in items)}"
+            # 在独立任务中广播，不阻塞定时器
+            asyncio.create_task(self.broadcast_messages(
+                label, texts, game_type, dedup_keys=[(f"{game_type}:expiring", code) for code, _ in items]))
+    
+    async def catch_up_sync(self):
+        """连接建立后的补偿同步：按本地高水位向后端请求增量兑换码，走正常的去重和推送流程"""
+        if self.sync_lock.locked() or not self.lease.is_leader:
+            return
+        async with self.sync_lock:
+            for game_type in GAME_TYPES.values():
+                if self.is_terminated:
                     return
-                
-                # 生成通知唯一标识，用于去重
-                notification_key = f"{game_name}_{key}_{time_str}"
-                current_time = time.time()
-                
-                # 检查是否是重复通知（10秒内的相同通知）
-                if notification_key in self.last_notification_time:
-                    if current_time - self.last_notification_time[notification_key] < 10:
-                        logger.info(f"忽略重复通知: {notification_key}")
-                        return
-                
-                # 记录通知时间
-                self.last_notification_time[notification_key] = current_time
-                
-                # 清理旧的通知记录（保留最近1小时的记录）
-                self._cleanup_old_notifications(current_time)
-                
-                logger.info(f"实例 {self.instance_id} 处理新兑换码: {game_name} - {key}")
-
-                game_display_name = self.get_game_display_name(game_name)
-                msg2 = key
-                msg1 = f"🎮 {game_display_name} 兑换码更新啦！\n兑换码：{key}\n奖励：{reward}\n有效期:{time_str}\n快上游戏兑换叭！\n源链接:{url}"
-                message_chain1 = MessageChain().message(msg1)
-                message_chain2 = MessageChain().message(msg2)
-                
-                for sub in self.subscribers:
-                    if not self.is_terminated:
-                        await self.context.send_message(sub, message_chain1)
-                        await asyncio.sleep(1)  # 延时1秒钟
-                        await self.context.send_message(sub, message_chain2)
-                        await asyncio.sleep(1)  # 延时1秒钟
-                
-            except Exception as e:
-                logger.error(f"处理新兑换码时出错: {str(e)}")
+                try:
+                    await self._sync_game(game_type)
+                except Exception as e:
+                    logger.error(f"同步 {game_type} 兑换码时出错: {e}")
+    
+    async def _sync_game(self, game_type, validators=None):
+        """同步一个游戏的增量兑换码；传入 validators 时为条件请求
+
+        返回是否有变化：发现了账本中没有的兑换码，或者响应内容和上一次不同。
+        后端不支持条件请求时每次都返回 200，只看状态码会让轮询一直停在最短间隔。
+        """
+        state_name = f"sync_hwm:{game_type}"
+        keys = await self._settle_sync(game_type, state_name)
+        hwm = await self.db.get_state(state_name)
+        started = time.time()
+        
+        # 后端只返回 since 之后新增的兑换码；即使返回了更多，去重账本也会挡住已推送的
+        params = {"since": int((hwm - SYNC_OVERLAP) * 1000)} if hwm else None
+        data = await self.fetch_codes(game_type, params=params, validators=validators)
+        if data is None:
+            # 没有变化，高水位也不动，下次请求的地址不变，条件请求才能继续命中
+            self.metrics.polls_not_modified.inc()
+            return False
+        if isinstance(data, str):
+            return False
+        changed = False
+        if validators is not None:
+            digest = hashlib.sha1(json.dumps(data, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+            changed = digest != validators.get('digest')
+            validators['digest'] = digest
+        
+        items = []
+        for item in data:
+            try:
+                if 'code' not in item or ('end' in item and parse_end_time(item['end']) <= started):
+                    continue
+            except Exception:
+                continue
+            items.append(item)
+        
+        if hwm is None:
+            # 第一次运行没有高水位，现有的兑换码只记入账本，不当作新兑换码推送
+            for item in items:
+                await self.dedup.record(game_type, item['code'])
+            logger.info(f"首次同步 {game_type}，记录了 {len(items)} 个现有兑换码")
+        else:
+            missed = [item for item in items if not self.dedup.seen(game_type, item['code'])]
+            if not missed:
+                # 没有新兑换码时高水位不动，下次请求的地址不变，条件请求才能继续命中
+                return changed
+            logger.info(f"补偿同步发现 {game_type} 断线期间的 {len(missed)} 个新兑换码")
+            changed = True
+            await asyncio.gather(*(self.handle_new_code({
+                'game_name': game_type,
+                'key': item['code'],
+                'reward': item.get('reward'),
+                'time': item.get('time') or item.get('end'),
+                'url': item.get('url'),
+            }) for item in missed))
+            keys += [item['code'] for item in missed]
+        
+        if any(not self.dedup.is_saved(game_type, key) for key in keys):
+            # 还在合并窗口里的兑换码只登记在内存中，进程退出或失去租约时下次同步还要再拿到，
+            # 等它们随发件箱落盘之后再推进高水位
+            self.sync_pending[game_type] = (started, keys)
+            return changed
+        self.sync_pending.pop(game_type, None)
+        await self.db.set_state(state_name, started)
+        return changed
+    
+    async def _settle_sync(self, game_type, state_name):
+        """上次同步发现的兑换码都已落盘时推进高水位，返回仍在等待落盘的兑换码"""
+        pending = self.sync_pending.get(game_type)
+        if pending is None:
+            return []
+        settle_at, keys = pending
+        unsaved = [key for key in keys if not self.dedup.is_saved(game_type, key)]
+        if any(self.dedup.seen(game_type, key) for key in unsaved):
+            return keys
+        del self.sync_pending[game_type]
+        if not unsaved:
+            await self.db.set_state(state_name, settle_at)
+        # 有登记被撤销时（失去推送节点租约）高水位不动，交给新的推送节点补发
+        return []
+    
+    async def poll_codes(self):
+        """推送不可用时轮询一遍所有游戏，返回是否有游戏的数据发生变化"""
+        if self.sync_lock.locked():
+            return True
+        changed = False
+        async with self.sync_lock:
+            for game_type in GAME_TYPES.values():
+                if self.is_terminated:
+                    break
+                self.metrics.polls.inc()
+                try:
+                    if await self._sync_game(game_type, validators=self.poll_validators.setdefault(game_type, {})):
+                        changed = True
+                except Exception as e:
+                    logger.error(f"轮询 {game_type} 兑换码时出错: {e}")
+        return changed
+    
+    async def _poll_while_push_down(self):
+        """推送连接不可用时改为轮询，没有变化时逐步拉长间隔；推送恢复后自动停止"""
+        interval = POLL_MIN_INTERVAL
+        while not self.is_terminated:
+            await asyncio.sleep(interval)
+            if self.is_terminated:
+                break
+            if (self.supervisor and self.supervisor.connected) or not self.lease.is_leader:
+                if self.polling:
+                    logger.info(f"实例 {self.instance_id} 推送已恢复，停止轮询")
+                    self.polling = False
+                interval = POLL_MIN_INTERVAL
+                continue
+            if not self.polling:
+                logger.warning(f"实例 {self.instance_id} 推送连接不可用，改为轮询兑换码接口")
+                self.polling = True
+            changed = await self.poll_codes()
+            interval = POLL_MIN_INTERVAL if changed else min(POLL_MAX_INTERVAL, interval * 2)
+            self.poll_interval = interval
+    
+    async def load_target_health(self):
+        """恢复会话推送失败记录"""
+        try:
+            count = await self.target_health.load()
+            logger.info(f"已恢复 {count} 条推送失败记录")
+        except Exception as e:
+            logger.error(f"加载推送失败记录失败: {e}")
     
-    def _cleanup_old_notifications(self, current_time):
-        """清理旧的通知记录"""
-        keys_to_remove = []
-        for key, timestamp in self.last_notification_time.items():
-            if current_time - timestamp > 3600:  # 清理1小时前的记录
-                keys_to_remove.append(key)
+    async def load_dedup(self):
+        """恢复去重账本"""
+        try:
+            count = await self.dedup.load()
+            logger.info(f"已恢复 {count} 条去重记录")
+        except Exception as e:
+            logger.error(f"加载去重记录失败: {e}")
+    
+    def render_code_digest(self, game_type, items):
+        """生成兑换码推送消息：一份详情，加上尽量少的纯兑换码消息方便复制"""
+        game_display_name = self.get_game_display_name(game_type)
+        keys = [item['key'] for item in items]
+        if len(items) == 1:
+            item = items[0]
+            return [f"🎮 {game_display_name} 兑换码更新啦！\n兑换码：{item['key']}\n奖励：{item['reward']}\n"
+                    f"有效期:{item['time']}\n快上游戏兑换叭！\n源链接:{item['url']}"] + keys
+        
+        blocks = [f"🎮 {game_display_name} 兑换码更新啦！共 {len(items)} 个"]
+        for item in items:
+            blocks.append(f"兑换码：{item['key']}\n奖励：{item['reward']}\n有效期:{item['time']}\n源链接:{item['url']}")
+        blocks.append("快上游戏兑换叭！")
+        return pack_lines(blocks, sep="\n\n") + pack_lines(keys)
+    
+    async def broadcast_codes(self, game_type, items):
+        """把同一游戏的一批兑换码推送给订阅了该游戏的用户"""
+        texts = self.render_code_digest(game_type, items)
+        label = f"{game_type} - {', '.join(item['key'] for item in items)}"
+        received_at = min(item['received_at'] for item in items)
+        await self.broadcast_messages(label, texts, game_type, received_at=received_at,
+                                      dedup_keys=[(game_type, item['key']) for item in items])
+    
+    async def broadcast_messages(self, label, texts, game_type=None, deliveries=None, received_at=None,
+                                 dedup_keys=None):
+        """通过发件箱推送消息：先整批落盘，再并发发送，每个订阅者送达后确认；
+        game_type 为推送的游戏，发给订阅了该游戏的用户；deliveries 为恢复遗留投递时的 {订阅者: 投递ID}；
+        received_at 为收到兑换码的 time.monotonic()，用于统计端到端延迟；
+        dedup_keys 为只在内存中登记过的去重记录，和发件箱在同一事务中落盘"""
+        if deliveries is None:
+            # 重载后新实例立即接手连接，订阅者可能还没加载完，不能发给空的订阅者列表
+            await self.subscribers_loaded
+            # 其他节点上的订阅/取消订阅只写在共享日志里，推送前增量读入
+            await self.refresh_subscribers()
+            # 持续失败的会话暂停推送，不再每次广播都重试
+            now = time.time()
+            targets = [t for t in self.subscriber_store.subscribers_of(game_type)
+                       if not self.target_health.is_parked(t, now)]
+            try:
+                deliveries = await self.outbox.enqueue(
+                    label, texts, targets, fence=self.lease.fence(),
+                    also=self.dedup.writer(dedup_keys) if dedup_keys else None)
+                self.dedup.saved(dedup_keys or ())
+            except LeaseLostError as e:
+                logger.warning(f"实例 {self.instance_id} 已不是推送节点，放弃广播 {label}: {e}")
+                # 交给新的推送节点补发
+                self.dedup.forget(dedup_keys or ())
+                return None
+            except Exception as e:
+                logger.error(f"写入推送发件箱失败，直接推送: {e}")
+                if dedup_keys:
+                    await self.dedup.persist(dedup_keys)
+                deliveries = {}
+            if not deliveries:
+                deliveries = dict.fromkeys(targets)
         
-        for key in keys_to_remove:
-            del self.last_notification_time[key]
+        metrics = self.metrics
+        unfinished = len(deliveries)
+        
+        def on_result(target, ok, error=None):
+            nonlocal unfinished
+            unfinished -= 1
+            self.inflight_deliveries -= 1
+            if ok:
+                metrics.deliveries.inc()
+                if received_at is not None:
+                    metrics.delivery_latency.observe(time.monotonic() - received_at)
+            else:
+                metrics.send_failures.inc()
+            if self.target_health.record(target, ok, error):
+                logger.warning(f"{target} 连续 {self.target_health.park_after} 次推送失败，暂停向其推送: {error}")
+            delivery_id = deliveries.get(target)
+            if delivery_id is not None:
+                self.outbox.ack(delivery_id, ok)
+        
+        # 并发推送，由令牌桶保证同一会话/平台的发送间隔
+        message_chains = [MessageChain().message(text) for text in texts]
+        self.inflight_deliveries += len(deliveries)
+        task = asyncio.current_task()
+        self.active_broadcasts.add(task)
+        try:
+            report = await self.broadcaster.broadcast(
+                deliveries.keys(), message_chains,
+                is_cancelled=lambda: self.is_terminated or not self.lease.is_leader, on_result=on_result)
+        finally:
+            # 被取消而没有结果的投递不再计入
+            self.inflight_deliveries -= unfinished
+            self.active_broadcasts.discard(task)
+        await self.outbox.flush()
+        await self.target_health.flush()
+        if received_at is not None and report.delivered:
+            metrics.broadcast_latency.observe(report.started_at + report.time_to_last_delivery - received_at)
+        logger.info(f"实例 {self.instance_id} 广播 {label} 完成: "
+                    f"订阅者 {report.targets}，成功 {report.delivered}，失败 {report.failed}，"
+                    f"最后送达耗时 {report.time_to_last_delivery:.2f} 秒")
+        return report
+    
+    async def load_outbox(self):
+        """读取发件箱中未确认的投递，并清理过期记录"""
+        try:
+            pending = await self.outbox.load_pending()
+            await self.outbox.purge()
+            return pending
+        except Exception as e:
+            logger.error(f"读取推送发件箱失败: {e}")
+            return []
+    
+    async def resume_outbox(self, pending):
+        """继续推送上次重启/重载前未送达的消息"""
+        for label, texts, deliveries in pending:
+            if self.is_terminated or not self.lease.is_leader:
+                return
+            # 已经取消订阅或暂停推送的用户不再补发
+            for target in [t for t in deliveries
+                           if t not in self.subscribers or self.target_health.is_parked(t)]:
+                self.outbox.ack(deliveries.pop(target), ok=False)
+            if deliveries:
+                logger.info(f"实例 {self.instance_id} 继续未完成的广播 {label}，剩余 {len(deliveries)} 个订阅者")
+                await self.broadcast_messages(label, texts, deliveries=deliveries)
+        await self.outbox.flush()
+    
+    def get_game_type(self, game_name):
+        """将推送中的游戏名转换为查询接口使用的游戏类型"""
+        return GAME_TYPES.get(game_name, game_name)
     
     def get_game_display_name(self, game_code):
         """将游戏代码转换为显示名称"""
@@ -206,116 +2367,101 @@ class MyPlugin(Star):
         }
         return game_names.get(game_code, game_code)
     
-    async def connect_websocket(self):
-        """连接到WebSocket服务器"""
-        if self.is_terminated or self.reconnecting:
-            return
-            
-        try:
-            self.reconnecting = True
-            
-            # 强制断开并重置客户端状态
-            try:
-                if self.sio and self.sio.connected:
-                    await self.sio.disconnect()
-                await asyncio.sleep(1)  # 等待完全断开
-            except Exception as disconnect_error:
-                logger.info(f"断开连接时的错误（可以忽略）: {disconnect_error}")
-            
-            # 重新初始化客户端
-            if not self.is_terminated:
-                self.sio = socketio.AsyncClient()
-                self.setup_socketio()  # 重新设置事件处理器
-                
-                # 尝试连接
-                await self.sio.connect('http://172.17.0.1:3000')
-                logger.info(f"实例 {self.instance_id} WebSocket连接成功")
-            
-            self.reconnecting = False
-        
-        except Exception as e:
-            logger.error(f"实例 {self.instance_id} WebSocket连接失败: {str(e)}")
-            self.reconnecting = False
-            if not self.is_terminated:
-                self.schedule_reconnect(10)  # 延长重连间隔到10秒
-
-    def schedule_reconnect(self, delay):
-        """调度一个新的重连任务，取消任何现有任务"""
-        if self.is_terminated:
-            return
-            
-        if self.reconnect_task and not self.reconnect_task.done():
-            self.reconnect_task.cancel()
-        self.reconnect_task = asyncio.create_task(self.delayed_reconnect(delay))
-    
-    async def delayed_reconnect(self, delay):
-        """延迟后尝试重新连接"""
-        try:
-            await asyncio.sleep(delay)
-            if not self.is_terminated:
-                await self.connect_websocket()
-        except Exception as e:
-            logger.error(f"重连过程中出错: {str(e)}")
-            # 如果重连失败，继续尝试（最多重试几次）
-            if delay < 60 and not self.is_terminated:  # 最大延迟60秒
-                self.schedule_reconnect(delay * 2)  # 指数退避
-
-    def load_subscribers(self):
+    async def load_subscribers(self):
         """从文件加载订阅者列表"""
         try:
-            if os.path.exists(self.data_file):
-                with open(self.data_file, "r", encoding="utf-8") as f:
-                    self.subscribers = set(json.load(f))
-
+            count = await self.subscriber_store.load()
+            logger.info(f"已加载 {count} 个订阅者")
         except Exception as e:
             logger.error(f"加载订阅者数据失败: {str(e)}")
-
-    def save_subscribers(self):
-        """保存订阅者列表到文件"""
+    
+    async def refresh_subscribers(self):
+        """读入其他节点写入订阅日志的变更"""
         try:
-            with open(self.data_file, "w", encoding="utf-8") as f:
-                json.dump(list(self.subscribers), f)
+            changed = await self.subscriber_store.refresh()
+            if changed:
+                logger.info(f"从订阅日志读入 {changed} 条其他节点的订阅变更")
         except Exception as e:
-            logger.error(f"保存订阅者数据失败: {str(e)}")
+            logger.error(f"刷新订阅者数据失败: {str(e)}")
     
-    async def fetch_codes(self, game_type):
-        """从API获取兑换码数据"""
-        import time
-        # 添加时间戳参数强制绕过缓存
-        url = f"{self.base_url}/{game_type}?_t={int(time.time() * 1000)}"
-        
-        try:
-            # 创建新的连接器，禁用连接复用
+    def get_http_session(self):
+        """获取共享的HTTP会话，不存在或已关闭时重新创建"""
+        if self.http_session is None or self.http_session.closed:
             connector = aiohttp.TCPConnector(
-                limit=0,           # 不限制连接数
-                limit_per_host=0,  # 不限制每个主机的连接数
-                ttl_dns_cache=0,   # 禁用DNS缓存
-                use_dns_cache=False # 不使用DNS缓存
+                limit=HTTP_MAX_CONNECTIONS,
+                keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=300,
             )
-            
-            # 每次都创建新的session
-            async with aiohttp.ClientSession(connector=connector) as session:
-                # 设置强制刷新的请求头
-                headers = {
-                    'Cache-Control': 'no-cache, no-store, must-revalidate, max-age=0',
-                    'Pragma': 'no-cache',
-                    'Expires': '0',
-                    'User-Agent': f'NikkiCodeTracker/{time.time()}'  # 每次不同的User-Agent
-                }
-                
-                async with session.get(url, headers=headers) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        logger.info(f"成功获取 {len(data) if isinstance(data, list) else 'unknown'} 条兑换码数据")
-                        return data
-                    else:
-                        logger.error(f"获取兑换码失败，HTTP状态码: {response.status}")
-                        return f"获取兑换码失败，HTTP状态码: {response.status}"
+            self.http_session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+                headers={'User-Agent': HTTP_USER_AGENT},
+            )
+        return self.http_session
+    
+    async def close_http_session(self):
+        """关闭共享的HTTP会话"""
+        if self.http_session and not self.http_session.closed:
+            try:
+                await self.http_session.close()
+            except Exception as e:
+                logger.error(f"关闭HTTP会话时出错: {e}")
+        self.http_session = None
+    
+    async def fetch_codes(self, game_type, params=None, validators=None):
+        """从API获取兑换码数据
+
+        传入 validators 时发起条件请求：用其中的 etag / last_modified 询问后端是否有变化，
+        没有变化（304）时返回 None，有变化时用响应头就地更新 validators
+        """
+        url = f"{self.base_url}/{game_type}"
+        # no-cache 要求中间缓存每次向后端重新验证，保证拿到最新数据，同时不影响连接复用
+        headers = {'Cache-Control': 'no-cache'}
+        if validators:
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+        
+        try:
+            async with self.http_semaphore:
+                session = self.get_http_session()
+                started = time.monotonic()
+                try:
+                    async with session.get(url, headers=headers, params=params) as response:
+                        if response.status == 304 and validators:
+                            return None
+                        if response.status == 200:
+                            if validators is not None:
+                                validators['etag'] = response.headers.get('ETag')
+                                validators['last_modified'] = response.headers.get('Last-Modified')
+                            data = await response.json()
+                            logger.info(f"成功获取 {len(data) if isinstance(data, list) else 'unknown'} 条兑换码数据")
+                            return data
+                        else:
+                            self.metrics.fetch_errors.inc()
+                            logger.error(f"获取兑换码失败，HTTP状态码: {response.status}")
+                            return f"获取兑换码失败，HTTP状态码: {response.status}"
+                finally:
+                    self.metrics.fetch_latency.observe(time.monotonic() - started)
+        except asyncio.TimeoutError:
+            self.metrics.fetch_errors.inc()
+            logger.error(f"获取兑换码超时: {url}")
+            return "获取兑换码超时，请稍后再试"
         except Exception as e:
+            self.metrics.fetch_errors.inc()
             logger.error(f"获取兑换码时发生错误: {str(e)}")
             return f"获取兑换码时发生错误: {str(e)}"
 
-
+    async def fetch_code_index(self, game_type):
+        """获取兑换码并预解析为 CodeIndex，失败时返回错误信息字符串"""
+        data = await self.fetch_codes(game_type)
+        if isinstance(data, str):
+            return data
+        index = CodeIndex(data)
+        for end_ts, code in index.entries:
+            self.expiry.track(game_type, code, end_ts)
+        return index
 
     def match_cmd(self, cmd):
         ret = ""
@@ -325,93 +2471,140 @@ class MyPlugin(Star):
             ret = "shining"
         elif cmd in ["深空", "恋与深空"]:
             ret = "deepspace"
+        elif cmd in ["全部", "所有", "all"]:
+            ret = "all"
         elif cmd in ["帮助", "help"]:
             ret = "help"
         else:
             ret = ""
         return ret
     
-    def make_ret(self, json_data):
-        """
-        解析JSON数据，检查兑换码有效性，返回有效的兑换码列表
-        """
-        # 如果json_data是字符串，很可能是错误消息
-        if isinstance(json_data, str):
-            return json_data
-        
-        valid_keys = []
-        current_time = datetime.datetime.now()
-        
-        # 遍历JSON数据中的每个兑换码
-        for code_item in json_data:
-            # 检查是否包含必要的字段
-            if 'code' in code_item and 'end' in code_item:
-                try:
-                    end_time_str = code_item['end']
-                    end_time = datetime.datetime.strptime(end_time_str, "%Y/%m/%d %H:%M:%S")
-                    # 检查兑换码是否仍然有效
-                    if current_time < end_time:
-                        valid_keys.append(code_item['code'])
-                except Exception as e:
-                    continue
-        
-        return valid_keys
-
+    def render_code_pages(self, games, indexes):
+        """把一个或多个游戏的有效兑换码排成尽量少的消息，每个兑换码单独一行便于复制"""
+        lines = []
+        for game_type, index in zip(games, indexes):
+            codes = index.valid_codes()
+            if len(games) > 1:
+                lines.append(f"【{self.get_game_display_name(game_type)}】")
+            if codes:
+                lines.extend(codes)
+            else:
+                lines.append("暂无兑换码")
+        # 预留页脚（翻页提示和网站地址）的长度
+        return pack_lines(lines, limit=MESSAGE_MAX_LENGTH - 100)
+    
     @filter.command("兑换码")
-    async def code(self, event: AstrMessageEvent, message: str):
+    async def code(self, event: AstrMessageEvent, message: str, page: int = 1):
         cmd = self.match_cmd(message)
-        ret = ""
-        if cmd in ["infinity", "shining", "deepspace"]:
-            json = await self.fetch_codes(cmd)
-            val = self.make_ret(json)
-            if isinstance(val, str):
-                ret = val
-            else:
-                if len(val) > 0:
-                    for key in val:
-                        yield event.plain_result(key)
-                        await asyncio.sleep(1)  # 延时1秒钟                        
-                else:
-                    yield event.plain_result("暂无兑换码")
-                ret = "详细信息请查看 http://code.infinitynikki.top/"
+        if cmd in ["infinity", "shining", "deepspace", "all"]:
+            games = list(GAME_TYPES.values()) if cmd == "all" else [cmd]
+            # 各游戏并发请求（缓存命中时不请求后端）
+            indexes = await asyncio.gather(*(self.code_cache.get(g) for g in games))
+            errors = [f"{self.get_game_display_name(g)}: {index}"
+                      for g, index in zip(games, indexes) if isinstance(index, str)]
+            if errors:
+                yield event.plain_result(errors[0] if len(games) == 1 else "\n".join(errors))
+                # 部分游戏失败时仍然返回其余游戏的兑换码
+                games = [g for g, index in zip(games, indexes) if not isinstance(index, str)]
+                indexes = [index for index in indexes if not isinstance(index, str)]
+                if not games:
+                    return
+            
+            pages = self.reply_cache.get(tuple(games), games, indexes)
+            page = min(max(page, 1), len(pages))
+            ret = pages[page - 1]
+            if len(pages) > 1:
+                ret += f"\n—— 第 {page}/{len(pages)} 页"
+                if page < len(pages):
+                    ret += f"，输入【/兑换码 {message} {page + 1}】查看下一页"
+            ret += f"\n详细信息请查看 {CODE_SITE_URL}"
+            yield event.plain_result(ret)
 
         elif cmd == "help": 
-            ret = "输入【/兑换码 游戏】获取兑换码"
+            yield event.plain_result("输入【/兑换码 游戏】获取兑换码，例如【/兑换码 暖5】；"
+                                     "【/兑换码 全部】获取所有游戏的兑换码；兑换码较多时用【/兑换码 游戏 页码】翻页")
 
         else:
-            ret = "输入【】内的指令【/兑换码 help】获取帮助"
-
-        yield event.plain_result(ret)    
+            yield event.plain_result("输入【】内的指令【/兑换码 help】获取帮助")
         
     @filter.command("兑换码网站")
     async def code_web(self, event: AstrMessageEvent):
-        yield event.plain_result("http://code.infinitynikki.top/")
+        yield event.plain_result(CODE_SITE_URL)
+    
+    def parse_sub_games(self, message):
+        """解析订阅指令中的游戏参数：空表示全部游戏，无法识别返回 None"""
+        if not message:
+            return set()
+        game_type = self.match_cmd(message)
+        if game_type == "all":
+            return set()
+        if game_type in GAME_TYPES.values():
+            return {game_type}
+        return None
+    
+    def describe_games(self, games):
+        """把订阅的游戏集合转成显示文本"""
+        if ALL_GAMES in games:
+            return "全部游戏"
+        return "、".join(self.get_game_display_name(g) for g in sorted(games))
     
     @filter.command("订阅兑换码")
-    async def sub_code(self, event: AstrMessageEvent):
+    async def sub_code(self, event: AstrMessageEvent, message: str = ""):
         umo = event.unified_msg_origin
+        await self.subscribers_loaded
         
-        # 检查是否已经订阅
-        if umo in self.subscribers:
-            yield event.plain_result("您已经订阅了兑换码推送，无需重复订阅")
+        games = self.parse_sub_games(message)
+        if games is None:
+            yield event.plain_result("输入【/订阅兑换码】订阅全部游戏，或【/订阅兑换码 游戏】只订阅某个游戏，例如【/订阅兑换码 暖5】")
+            return
+        
+        # 添加到订阅索引，变更追加写入日志
+        try:
+            changed = await self.subscriber_store.add(umo, games)
+        except Exception as e:
+            changed = True
+            logger.error(f"保存订阅者数据失败: {str(e)}")
+        
+        # 重新订阅视为会话已恢复，清除推送失败记录
+        self.target_health.reset(umo)
+        await self.target_health.flush()
+        
+        current = self.describe_games(self.subscriber_store.games_of(umo))
+        if not changed:
+            yield event.plain_result(f"您已经订阅了兑换码推送，无需重复订阅（当前订阅：{current}）")
         else:
-            # 添加到订阅者集合
-            self.subscribers.add(umo)
-            self.save_subscribers()
-            yield event.plain_result("✅ 订阅成功！当有新的兑换码时，我们将会通知您")
-            logger.info(f"新用户订阅了兑换码: {umo}")
+            yield event.plain_result(f"✅ 订阅成功！当有新的兑换码时，我们将会通知您（当前订阅：{current}）")
+            logger.info(f"用户订阅了兑换码: {umo} -> {current}")
 
     @filter.command("取消订阅兑换码")
-    async def desub_code(self, event: AstrMessageEvent):
+    async def desub_code(self, event: AstrMessageEvent, message: str = ""):
         umo = event.unified_msg_origin
+        await self.subscribers_loaded
+        
+        games = self.parse_sub_games(message)
+        if games is None:
+            yield event.plain_result("输入【/取消订阅兑换码】取消全部订阅，或【/取消订阅兑换码 游戏】只取消某个游戏")
+            return
         
         # 检查是否已经订阅
         if umo in self.subscribers:
-            # 从订阅者集合中移除
-            self.subscribers.remove(umo)
-            self.save_subscribers()
-            yield event.plain_result("✅ 已取消订阅兑换码推送")
-            logger.info(f"用户取消了兑换码订阅: {umo}")
+            # 从订阅索引中移除，变更追加写入日志
+            try:
+                changed = await self.subscriber_store.remove(umo, games)
+            except Exception as e:
+                changed = True
+                logger.error(f"保存订阅者数据失败: {str(e)}")
+            
+            if not changed:
+                current = self.describe_games(self.subscriber_store.games_of(umo))
+                yield event.plain_result(f"您没有订阅该游戏（当前订阅：{current}）")
+            elif umo in self.subscribers:
+                current = self.describe_games(self.subscriber_store.games_of(umo))
+                yield event.plain_result(f"✅ 已取消该游戏的推送（当前订阅：{current}）")
+                logger.info(f"用户取消了部分兑换码订阅: {umo} -> {current}")
+            else:
+                yield event.plain_result("✅ 已取消订阅兑换码推送")
+                logger.info(f"用户取消了兑换码订阅: {umo}")
         else:
             # 用户未订阅
             yield event.plain_result("您当前没有订阅兑换码推送")
@@ -420,9 +2613,11 @@ class MyPlugin(Star):
     async def sub_status(self, event: AstrMessageEvent):
         umo = event.unified_msg_origin
         logger.info(f"用户查询了订阅状态： {umo}")
+        await self.subscribers_loaded
 
         if umo in self.subscribers:
-            yield event.plain_result("✅ 您当前已订阅兑换码推送")
+            current = self.describe_games(self.subscriber_store.games_of(umo))
+            yield event.plain_result(f"✅ 您当前已订阅兑换码推送（{current}）")
         else:
             yield event.plain_result("❌ 您当前未订阅兑换码推送")
 
@@ -430,9 +2625,9 @@ class MyPlugin(Star):
     @filter.command("订阅测试")
     async def sub_test(self, event: AstrMessageEvent):
         message_chain = MessageChain().message(f"订阅广播测试! (实例 {self.instance_id})")
-        for sub in self.subscribers:
-            await self.context.send_message(sub, message_chain)
-            await asyncio.sleep(1)  # 延时1秒钟
+        report = await self.broadcaster.broadcast(self.subscribers, [message_chain])
+        yield event.plain_result(f"广播测试完成：成功 {report.delivered}，失败 {report.failed}，"
+                                 f"最后送达耗时 {report.time_to_last_delivery:.2f} 秒")
             
     @filter.permission_type(PermissionType.ADMIN)
     @filter.command("订阅列表查询")
@@ -440,7 +2635,7 @@ class MyPlugin(Star):
         ret = f"当前实例: {self.instance_id}\n"
         if len(self.subscribers) > 0:
             for s in self.subscribers:
-                ret += s
+                ret += f"{s} ({self.describe_games(self.subscriber_store.games_of(s))})"
                 ret += "\n"
         else:
             ret += "❌没有订阅用户"
@@ -449,13 +2644,17 @@ class MyPlugin(Star):
     @filter.permission_type(PermissionType.ADMIN)
     @filter.command("重载订阅列表")
     async def sub_refresh(self, event: AstrMessageEvent):
-        self.load_subscribers()        
-        ret = "✅ 刷新成功"
+        try:
+            changes = await self.subscriber_store.refresh()
+            ret = f"✅ 刷新成功，应用了 {changes} 条变更"
+        except Exception as e:
+            logger.error(f"重载订阅者数据失败: {str(e)}")
+            ret = f"❌ 刷新失败: {str(e)}"
         yield event.plain_result(ret)
         ret = f"当前实例: {self.instance_id}\n"
         if len(self.subscribers) > 0:
             for s in self.subscribers:
-                ret += s
+                ret += f"{s} ({self.describe_games(self.subscriber_store.games_of(s))})"
                 ret += "\n"
         else:
             ret += "❌没有订阅用户"
@@ -465,31 +2664,54 @@ class MyPlugin(Star):
     @filter.command("连接状态")
     async def connection_status(self, event: AstrMessageEvent):
         status = f"实例ID: {self.instance_id}\n"
-        status += f"WebSocket连接: {'已连接' if self.sio and self.sio.connected else '未连接'}\n"
-        status += f"重连中: {'是' if self.reconnecting else '否'}\n"
+        role = f"推送节点（令牌 {self.lease.token}）" if self.lease.is_leader else f"热备（推送节点: {self.lease.holder}）"
+        status += f"节点: {self.lease.node_id}，{role}\n"
+        status += (self.supervisor.describe() if self.supervisor else "WebSocket连接: 未创建") + "\n"
+        if self.polling:
+            status += f"轮询兜底: 进行中，当前间隔 {self.poll_interval} 秒\n"
         status += f"已终止: {'是' if self.is_terminated else '否'}\n"
         status += f"收到事件数: {self.event_counter}\n"
         status += f"活跃实例数: {len(_plugin_instances)}"
         yield event.plain_result(status)
+    
+    @filter.permission_type(PermissionType.ADMIN)
+    @filter.command("推送异常列表")
+    async def parked_list(self, event: AstrMessageEvent):
+        parked = self.target_health.parked()
+        if not parked:
+            yield event.plain_result("✅ 没有暂停推送的会话")
+            return
+        ret = f"暂停推送的会话（{len(parked)} 个）:\n"
+        for target, (failures, last_error, parked_at) in parked.items():
+            since = datetime.datetime.fromtimestamp(parked_at).strftime(CODE_TIME_FORMAT)
+            ret += f"{target} 连续失败 {failures} 次，{since} 起暂停，最后错误: {last_error}\n"
+        ret += "输入【/恢复推送 会话】恢复单个会话，【/恢复推送】恢复全部"
+        yield event.plain_result(ret)
+    
+    @filter.permission_type(PermissionType.ADMIN)
+    @filter.command("恢复推送")
+    async def unpark(self, event: AstrMessageEvent, target: str = ""):
+        self.target_health.reset(target or None)
+        await self.target_health.flush()
+        yield event.plain_result(f"✅ 已恢复向 {target or '全部会话'} 推送")
+    
+    @filter.permission_type(PermissionType.ADMIN)
+    @filter.command("插件指标")
+    async def metrics_status(self, event: AstrMessageEvent):
+        ret = f"实例ID: {self.instance_id}\n"
+        ret += self.metrics.summary()
+        yield event.plain_result(ret)
         
     async def terminate(self):
         '''当插件被卸载/停用时会调用'''
         logger.info(f"正在终止插件实例 {self.instance_id}")
         
-        # 标记为已终止
-        self.is_terminated = True
-        
-        # 从全局实例字典中移除
-        _plugin_instances.pop(self.instance_id, None)
+        # 标记为已终止，停止开始新的投递
+        self._prepare_handover()
         
-        # 取消重连任务
-        if self.reconnect_task and not self.reconnect_task.done():
-            self.reconnect_task.cancel()
-            
-        # 断开WebSocket连接
-        if self.sio and self.sio.connected:
-            try:
-                await self.sio.disconnect()
-                logger.info(f"实例 {self.instance_id} WebSocket连接已关闭")
-            except Exception as e:
-                logger.error(f"关闭WebSocket连接时出错: {e}")
+        if self.supervisor and self.supervisor.connected:
+            # AstrBot 重载插件时先调用 terminate 再创建新实例，保留连接等待新实例接管
+            logger.info(f"实例 {self.instance_id} 保留WebSocket连接 {HANDOVER_GRACE} 秒等待新实例接管")
+            self.handover_timer = asyncio.create_task(self._release_after_grace())
+        else:
+            await self._release()
@@ -0,0 +1,141 @@
+"""SubscriberStore 的日志、合并与旧版 subscribers.json 迁移"""
+import asyncio
+import json
+import threading
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def paths(tmp_path):
+    return str(tmp_path / "subscribers.json"), str(tmp_path / "subscribers.journal")
+
+
+def make_store(paths, **kwargs):
+    return main.SubscriberStore(*paths, **kwargs)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def reload(paths):
+    store = make_store(paths)
+    run(store.load())
+    return store
+
+
+def test_journal_survives_reload(paths):
+    async def scenario():
+        store = make_store(paths)
+        await store.load()
+        await store.add("a", {"infinity"})
+        await store.add("b")
+        await store.add("c", {"infinity", "shining"})
+        await store.remove("c", {"infinity"})
+        await store.remove("b")
+        return store
+
+    store = run(scenario())
+    fresh = reload(paths)
+    assert fresh.subscriptions == store.subscriptions == {"a": {"infinity"}, "c": {"shining"}}
+    assert fresh.subscribers_of("infinity") == {"a"}
+
+
+def test_remove_one_game_from_all_games(paths):
+    async def scenario():
+        store = make_store(paths)
+        await store.load()
+        await store.add("a")
+        await store.remove("a", {"infinity"})
+        return store
+
+    store = run(scenario())
+    expected = set(main.GAME_TYPES.values()) - {"infinity"}
+    assert store.games_of("a") == expected
+    assert reload(paths).games_of("a") == expected
+
+
+def test_refresh_applies_other_process_appends_once(paths):
+    async def scenario():
+        a, b = make_store(paths), make_store(paths)
+        await a.load()
+        await b.load()
+        await b.add("b1")
+        await a.add("a1")  # b1 还没读到，a1 记在 own_appends 里
+        await b.add("b2")
+        applied = await a.refresh()
+        return a, applied
+
+    a, applied = run(scenario())
+    assert applied == 2
+    assert set(a.subscribers) == {"a1", "b1", "b2"}
+    assert a.journal_entries == 3
+    assert not a.own_appends
+    # 自己的追加不会在下一次 refresh 时再应用一遍
+    assert run(a.refresh()) == 0
+
+
+def test_refresh_after_other_process_compacts(paths):
+    async def scenario():
+        a, b = make_store(paths), make_store(paths, compact_threshold=2)
+        await a.load()
+        await b.load()
+        await a.add("a1")
+        await b.add("b1")  # 达到阈值，b 合并快照并清空日志
+        await b.add("b2")
+        await a.refresh()
+        return a
+
+    a = run(scenario())
+    assert set(a.subscribers) == {"a1", "b1", "b2"}
+
+
+def test_compaction_keeps_concurrent_appends(paths, monkeypatch):
+    a, b = make_store(paths, compact_threshold=2), make_store(paths)
+    run(a.load())
+    run(b.load())
+    write_snapshot = main.SubscriberStore._write_snapshot
+    appenders = []
+
+    def write_snapshot_racing(self, subscriptions):
+        # a 已经读完日志、还没清空时，另一个进程追加一行
+        if self is a:
+            appender = threading.Thread(target=b._append, args=({"op": "add", "umo": "B2"},))
+            appender.start()
+            appender.join(0.2)
+            appenders.append(appender)
+        return write_snapshot(self, subscriptions)
+
+    monkeypatch.setattr(main.SubscriberStore, "_write_snapshot", write_snapshot_racing)
+
+    async def scenario():
+        await a.add("A1")
+        await a.add("A2")
+
+    run(scenario())
+    for appender in appenders:
+        appender.join()
+    assert appenders
+    assert set(reload(paths).subscribers) == {"A1", "A2", "B2"}
+
+
+def test_migrates_legacy_list_snapshot(paths):
+    snapshot_path, _ = paths
+    with open(snapshot_path, "w", encoding="utf-8") as f:
+        json.dump(["a", "b"], f)
+
+    async def scenario():
+        store = make_store(paths, compact_threshold=1)
+        await store.load()
+        await store.add("c", {"infinity"})  # 触发合并，快照改写为新格式
+        return store
+
+    store = run(scenario())
+    assert store.subscribers_of("shining") == {"a", "b"}
+    assert store.subscribers_of("infinity") == {"a", "b", "c"}
+    with open(snapshot_path, encoding="utf-8") as f:
+        assert json.load(f) == {"a": [main.ALL_GAMES], "b": [main.ALL_GAMES], "c": ["infinity"]}
+    assert reload(paths).subscriptions == store.subscriptions